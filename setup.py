@@ -19,6 +19,9 @@ extras_require = dict(test=['zope.testing', 'mock', 'manuel'])
 entry_points = """
 [console_scripts]
 setup-volumes = zc.awsrecipes:setup_volumes_main
+prewarm-volumes = zc.awsrecipes.prewarm:main
+snapshot-volumes = zc.awsrecipes.snapshot:main
+benchmark-volumes = zc.awsrecipes.benchmark:main [test]
 """
 
 from setuptools import setup
@@ -37,7 +40,7 @@ setup(
     install_requires = install_requires,
     zip_safe = False,
     entry_points=entry_points,
-    package_data = {name: ['*.txt', '*.test', '*.html']},
+    package_data = {name: ['*.txt', '*.test', '*.html', 'recorded/*.json']},
     extras_require = extras_require,
     tests_require = extras_require['test'],
     test_suite = name+'.tests.test_suite',
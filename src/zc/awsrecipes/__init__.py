@@ -1,42 +1,228 @@
+import contextlib
+import optparse
 import os
+import Queue
 import re
-import subprocess
 import sys
-import tempfile
+import threading
 import time
+import zc.awsrecipes.applied
+import zc.awsrecipes.commands
+import zc.awsrecipes.devices
+import zc.awsrecipes.filesystems
+import zc.awsrecipes.journal
+import zc.awsrecipes.mounts
+import zc.awsrecipes.plan
+import zc.awsrecipes.prewarm
+import zc.awsrecipes.replay
+import zc.awsrecipes.status
+import zc.awsrecipes.storage
+import zc.awsrecipes.timing
+import zc.awsrecipes.tuning
+import zc.awsrecipes.watch
 
 
 path_needed = set(('/usr/sbin', '/bin', '/sbin'))
 
+class Output:
+    """Serialize output from concurrent jobs.
 
-def s(command, should_raise=True):
-    print command
-    if subprocess.call(command, shell=True):
-        if should_raise:
-            raise SystemError(command)
-        return False
-    return True
-
-def p(command):
-    print command
-    f = tempfile.TemporaryFile(prefix='awsrecipes')
-    if subprocess.call(command, stdout=f, stderr=subprocess.STDOUT, shell=True):
-        raise SystemError(command)
-    f.seek(0)
-    for line in f:
-        yield line
-    f.close()
+    Each job gets a block of lines. Blocks are printed whole, in the
+    order the jobs were submitted, so output matches what a serial run
+    would have printed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = []
+        self.local = threading.local()
+
+    def say(self, line):
+        self.lock.acquire()
+        try:
+            block = getattr(self.local, 'block', None)
+            if block is not None:
+                block[1].append(line)
+            elif self.blocks:
+                # Main-thread output while jobs are pending:
+                self.blocks.append([True, [line]])
+            else:
+                print line
+        finally:
+            self.lock.release()
+
+    def capturing(self):
+        return getattr(self.local, 'block', None) is not None
+
+    @contextlib.contextmanager
+    def quiet(self):
+        """Drop what the current thread says
+        """
+        self.local.block = [False, []] # Never printed
+        try:
+            yield
+        finally:
+            self.local.block = None
+
+    def start(self):
+        block = [False, []]
+        self.lock.acquire()
+        try:
+            self.blocks.append(block)
+        finally:
+            self.lock.release()
+        return block
+
+    def done(self, block):
+        self.lock.acquire()
+        try:
+            block[0] = True
+            while self.blocks and self.blocks[0][0]:
+                for line in self.blocks.pop(0)[1]:
+                    print line
+        finally:
+            self.lock.release()
+
+output = Output()
+say = output.say
+
+class Pool:
+    """Run jobs in a bounded set of worker threads.
+    """
+
+    def __init__(self, size):
+        self.queue = Queue.Queue()
+        self.errors = []
+        self.threads = [threading.Thread(target=self.work)
+                        for i in range(size)]
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, func, *args, **kw):
+        self.queue.put((output.start(), func, args, kw))
+
+    def work(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                break
+            block, func, args, kw = job
+            output.local.block = block
+            try:
+                try:
+                    func(*args, **kw)
+                except Exception, v:
+                    say('%s: %s' % (v.__class__.__name__, v))
+                    self.errors.append(sys.exc_info())
+            finally:
+                output.local.block = None
+                output.done(block)
+
+    def join(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0][0], self.errors[0][1], self.errors[0][2]
+
+class Serial:
+    """Stand-in for a Pool that runs jobs immediately.
+    """
+
+    def submit(self, func, *args, **kw):
+        func(*args, **kw)
+
+    def join(self):
+        pass
+
+def s(*argv, **kw):
+    """Run a command, showing its output
+
+    Keyword arguments are passed to zc.awsrecipes.commands.run, and
+    the result is returned.
+    """
+    return zc.awsrecipes.commands.run(argv, **kw)
+
+def p(*argv, **kw):
+    """Run a command and return its output lines
+    """
+    return zc.awsrecipes.commands.run(argv, echo=False, **kw).lines()
+
+# Retries for commands that can find a new device briefly busy, as
+# udev probes it:
+busy_retries = 3
+
+raid_levels = '0', '10'
+default_chunk = 512 # KiB
+cache_modes = 'writethrough', 'writeback'
+bitmaps = 'internal', 'none'
+
+def parse_size(size):
+    """Parse a size in KiB, with an optional K or M suffix
+    """
+    units = 1
+    if size[-1:].upper() == 'K':
+        size = size[:-1]
+    elif size[-1:].upper() == 'M':
+        size = size[:-1]
+        units = 1024
+    try:
+        return int(size) * units
+    except ValueError:
+        raise ValueError("Bad size", size)
+
+def parse_chunk(size, what='Chunk'):
+    """Parse a chunk (or stripe) size, which must be a power of 2
+    """
+    chunk = parse_size(size)
+    if chunk < 4 or chunk & (chunk - 1):
+        raise ValueError(
+            "%s size must be a power of 2, at least 4K" % what, size)
+    return chunk
 
 class LogicalVolume:
 
-    def __init__(self, name, sdvols, path):
+    def __init__(self, name, sdvols, path, fs=None, raid='10', chunk=None,
+                 cache=None, cache_mode='writethrough', bitmap=None,
+                 bitmap_chunk=None, **tuning):
         self.name = name
         self.path = path
+        self.fs = zc.awsrecipes.filesystems.get(fs)
+        self.mount_options = mount_options(tuning).options(self.fs)
+        self.tuning = zc.awsrecipes.tuning.Tuning(**tuning)
+        if raid not in raid_levels:
+            raise ValueError("Unsupported raid level", raid)
+        self.level = raid
+        if chunk is None:
+            self.chunk = default_chunk
+        else:
+            self.chunk = parse_chunk(chunk)
+        # Ephemeral devices to cache the volume on:
+        self.cache = cache and cache.split(',') or []
+        if cache_mode not in cache_modes:
+            raise ValueError("Unsupported cache mode", cache_mode)
+        self.cache_mode = cache_mode
+        # Write-intent bitmaps, if we manage them:
+        if bitmap_chunk is not None:
+            if bitmap is None:
+                bitmap = 'internal'
+            elif bitmap != 'internal':
+                raise ValueError(
+                    "bitmap_chunk needs an internal bitmap", bitmap)
+            bitmap_chunk = parse_chunk(bitmap_chunk, 'Bitmap chunk')
+        if bitmap not in (None, ) + bitmaps:
+            raise ValueError("Unsupported bitmap", bitmap)
+        self.bitmap = bitmap
+        self.bitmap_chunk = bitmap_chunk
         self.mds = set()
         self.pvs = set()
         self.used = set()
         self.sdvols = set(sdvols)
         self.logical = False
+        self.activated = None # The step activating the volume group
+        self.mdnum = None
 
     def add_md(self, mdnum, volumes):
         assert not [v for v in volumes if not v.startswith(self.name)]
@@ -45,216 +231,1138 @@ class LogicalVolume:
             'repeated volume', volumes)
         self.used.update(volumes)
 
-    def has_logical_volume(self):
+    def has_logical_volume(self, storage, plan):
+        """Note that the volume group exists, and plan activating it
+        """
         self.logical = True
-        s('vgchange -a y vg_'+self.name)
+        vg = 'vg_' + self.name
+        if '[unknown]' in storage.vgs[vg]:
+            # Physical volumes are missing.  If our arrays are all
+            # there, they must be cache devices, which were ephemeral
+            # and didn't survive replacing the instance.
+            if not (self.cache and self.pvs == self.mds):
+                raise SystemError("Missing physical volumes", vg)
+            if self.cache_mode == 'writeback':
+                # Data not yet written back are lost.
+                raise SystemError(
+                    "Lost a writeback cache. The volume may be inconsistent"
+                    " and must be repaired by hand.", vg)
+            argv = ['vgreduce', '--removemissing', '--force', vg]
+            plan.add(zc.awsrecipes.commands.format(argv), self.lost_cache,
+                     (argv, ), volume=self.path,
+                     estimate=zc.awsrecipes.plan.estimate(argv))
+        self.activated = plan.command(['vgchange', '-a', 'y', vg],
+                                      volume=self.path)
+
+    def lost_cache(self, argv):
+        say('vg_%s lost its cache' % self.name)
+        s(*argv)
+
+    def add_cache(self, storage, plan):
+        """Plan caching the volume on the cache devices, unless it is already
+        """
+        vg = 'vg_' + self.name
+        cache = ['/dev/' + name for name in self.cache]
+        if not [path for path in cache if storage.pvs.get(path) != vg]:
+            return
+        for path in cache:
+            plan.command(['pvcreate', path], volume=self.path,
+                         then=lambda path=path: storage.add_pv(path, vg),
+                         retries=busy_retries)
+        plan.command(['vgextend', vg] + cache, volume=self.path)
+        plan.command(['lvcreate', '--type', 'cache', '--cachemode',
+                      self.cache_mode, '-l', '100%PVS', '-n', 'cache',
+                      vg + '/data'] + cache, volume=self.path)
+
+    def stripe(self, n):
+        """Return the chunk size and number of data disks in an array
+
+        for an array of n volumes.
+        """
+        if self.level == '0':
+            return self.chunk, n
+        if n % 2:
+            # With an odd number of volumes, the mirrored chunks don't
+            # line up in stripes, so all we can do is align with chunks.
+            return self.chunk, 1
+        return self.chunk, n // 2
+
+    def bitmap_options(self):
+        if self.bitmap == 'internal' and self.bitmap_chunk:
+            return ['--bitmap=internal',
+                    '--bitmap-chunk=%sK' % self.bitmap_chunk]
+        return ['--bitmap=%s' % self.bitmap]
+
+    def bitmap_commands(self, array):
+        """Return the commands to give an existing array the bitmap we want
+        """
+        if self.bitmap == 'none':
+            if not array.bitmap:
+                return []
+            commands = [['--bitmap=none']]
+        elif (array.bitmap and not array.bitmap_file and
+              self.bitmap_chunk in (None, array.bitmap)):
+            return []
+        else:
+            # To change the chunk size, or replace an external bitmap
+            # with an internal one, we have to remove the bitmap first.
+            commands = array.bitmap and [['--bitmap=none']] or []
+            commands.append(self.bitmap_options())
+        return [['mdadm', '--grow'] + options + [array.path]
+                for options in commands]
+
+    def update_bitmap(self, path, commands):
+        """Run the commands to change an array's bitmap
+
+        An array's bitmap can't be changed while it's resyncing, so
+        failures are reported, rather than raised.
+        """
+        for argv in commands:
+            if not s(*argv, check=False).ok:
+                say("couldn't change the bitmap of %s" % path)
+                return
+
+    def reserve_md(self, storage):
+        # Pick the md number for a new raid volume up front, so volumes
+        # can be set up concurrently without racing for numbers.
+        if self.sdvols - self.used:
+            self.mdnum = storage.allocate_md()
+
+    def resume(self, storage, journal, entry):
+        """Check an unfinished journal entry against what's there
+
+        Return the entry, if the array it's for exists.  If the array
+        was never created, the entry is dropped, and None is returned.
+        """
+        devices = entry['devices']
+        mdnums = set(storage.members.get(name) for name in devices)
+        if mdnums == set([None]):
+            journal.drop(self.path)
+            return None
+        if (len(mdnums) != 1 or None in mdnums or
+            sorted(storage.arrays[list(mdnums)[0]].members) != devices or
+            entry['vg'] != 'vg_' + self.name):
+            raise SystemError("The journal doesn't match the arrays",
+                              self.path, entry)
+        # The array may have been assembled with a different number:
+        entry['md'] = list(mdnums)[0]
+        return entry
+
+    def size(self, devices):
+        """Estimate the bytes of data an array of the devices holds
+        """
+        size = zc.awsrecipes.plan.size(devices)
+        if self.level == '10':
+            size //= 2
+        return size
+
+    def create(self, storage, journal, steps, identity, argv):
+        journal.begin(self.path, steps, **identity)
+        s(*argv, retries=busy_retries)
+        storage.add_array(zc.awsrecipes.storage.Array(
+            identity['md'], 'active', 'raid' + self.level,
+            identity['devices']))
+        journal.done(self.path, 'create')
+
+    def take(self, journal, steps, argv, kw, then, message):
+        """Take a step of making an array, and record it in the journal
+
+        steps are the journal steps done by taking it, which may
+        include earlier steps found to have been taken already.
+        """
+        if message:
+            say(message)
+        s(*argv, **kw)
+        if then is not None:
+            then()
+        for step in steps:
+            journal.done(self.path, step)
+
+    def finish(self, plan, storage, journal, entry, resuming=False):
+        """Plan the steps after creating an array that aren't done
+
+        When resuming, steps that may have been taken without being
+        recorded as done are checked first, or allowed to fail.
+        Return whether the file system is to be grown.
+        """
+        mdnum = entry['md']
+        md = '/dev/md%s' % mdnum
+        vg = 'vg_' + self.name
+        data = '/dev/%s/data' % vg
+        chunk, disks = stripe = self.stripe(len(entry['devices']))
+        size = self.size(entry['devices'])
+        message = resuming and 'resuming setting up %s at %s' % (
+            self.path, [step for step in entry['steps']
+                        if step not in entry['done']][0])
+        taken = [] # Steps found to be done
+        grow = False
+        for step in entry['steps']:
+            if step in entry['done']:
+                continue
+            kw = {}
+            then = None
+            if step == 'create':
+                # The array exists, or we wouldn't be here.
+                taken.append(step)
+                continue
+            elif step == 'pvcreate':
+                if md in storage.pvs:
+                    taken.append(step)
+                    continue
+                # Start the LVM data area on a stripe boundary:
+                argv = ['pvcreate', '--dataalignment',
+                        '%sk' % (chunk * disks), md]
+                kw = dict(retries=busy_retries)
+                then = lambda: storage.add_pv(md)
+            elif step in ('vgextend', 'vgcreate'):
+                if storage.pvs.get(md) == vg:
+                    taken.append(step)
+                    continue
+                argv = [step, vg, md]
+                then = lambda: storage.add_pv(md, vg)
+            elif step == 'lvextend':
+                argv = ['lvextend', '-l', '+100%FREE', data]
+                if self.cache:
+                    # Keep the data off the cache devices:
+                    argv.append(md)
+                kw = dict(check=not resuming)
+            elif step == 'lvcreate':
+                argv = ['lvcreate', '-l', '+100%FREE', '-n', 'data', vg]
+                kw = dict(check=not resuming)
+            elif step == 'mkfs':
+                argv = self.fs.mkfs(data, stripe=stripe)
+                kw = dict(retries=busy_retries)
+            elif step == 'grow':
+                # After mounting.  It's recorded as done when it is.
+                grow = True
+                continue
+            plan.add(zc.awsrecipes.commands.format(argv), self.take,
+                     (journal, taken + [step], argv, kw, then, message),
+                     volume=self.path,
+                     estimate=zc.awsrecipes.plan.estimate(argv, size))
+            taken = []
+            message = None
+        self.mds.add(mdnum)
+        self.pvs.add(mdnum)
+        self.logical = True
+        return grow
+
+    def plan(self, plan, storage, grows, journal):
+        """Plan setting up the volume
+
+        If we extend an existing volume, its file system is mounted as
+        soon as its volume group is activated, and the steps extending
+        it come after.  The file system is grown in the background.
+        When that step is taken, the file system type, data device and
+        mount point are appended to grows.
+
+        The steps of making a new array are recorded in the journal,
+        and unfinished steps from an earlier run are taken first.
+        """
+        fs = self.fs
+        vg = 'vg_' + self.name
+        data = '/dev/%s/data' % vg
+        path = self.path
+        entry = journal.get(path)
+        if entry is not None:
+            entry = self.resume(storage, journal, entry)
+
+        mount = path not in mounted()
+        if (mount and self.activated is not None and
+            not (entry and 'mkfs' in entry['steps'])):
+            # The existing data are mounted right away, and don't wait
+            # for the volume to be extended.
+            self.mount(plan, data, after=[self.activated])
+            mount = False
+
+        if self.bitmap:
+            for mdnum in sorted(self.mds):
+                commands = self.bitmap_commands(storage.arrays[mdnum])
+                if commands:
+                    plan.add(
+                        '; '.join(zc.awsrecipes.commands.format(argv)
+                                  for argv in commands),
+                        self.update_bitmap, (storage.arrays[mdnum].path,
+                                             commands),
+                        volume=path,
+                        estimate=sum(zc.awsrecipes.plan.estimate(argv)
+                                     for argv in commands))
+
+        grow = False
+        if entry is not None:
+            grow = self.finish(plan, storage, journal, entry, True)
 
-    def setup(self):
         assert self.pvs == self.mds, (
             "Physical volumes in logical volumes don't match the raid"
             " volumes we found.", self.pvs, self.mds
             )
         unused = sorted(self.sdvols - self.used)
         if unused:
-            mdnum = 0
-            while os.path.exists('/dev/md%s' % mdnum):
-                mdnum += 1
-            s('mdadm --create --metadata 1.2 -l10 -n%s /dev/md%s %s'
-              % (len(unused), mdnum, ' '.join('/dev/' + u for u in unused))
-              )
+            mdnum = self.mdnum
+            if (self.level == '0' or
+                [u for u in unused if not storage.is_new(u)]):
+                clean = []
+            else:
+                # The volumes are all brand new, and so read as zeros.
+                # The mirrors already match, so there's no need for an
+                # initial resync.
+                clean = ['--assume-clean']
+            if self.bitmap:
+                bitmap = self.bitmap_options()
+            else:
+                bitmap = []
             if self.logical:
-                s('pvcreate /dev/md%s' % mdnum)
-                s('vgextend vg_%s /dev/md%s' % (self.name, mdnum))
-                s('lvextend -l +100%%FREE /dev/vg_%s/data'
-                  % self.name)
-                s('resize2fs /dev/vg_%s/data' % self.name)
+                steps = 'create', 'pvcreate', 'vgextend', 'lvextend', 'grow'
             else:
-                s('vgcreate vg_%s /dev/md%s' % (self.name, mdnum))
-                s('lvcreate -l +100%%FREE -n data vg_%s' % self.name)
-                s('mkfs -t ext3 /dev/vg_%s/data' % self.name)
-                self.logical = True
+                steps = 'create', 'pvcreate', 'vgcreate', 'lvcreate', 'mkfs'
+            identity = dict(md=mdnum, devices=unused, vg=vg, fs=fs.name,
+                            data=data)
+            argv = (['mdadm', '--create', '--metadata', '1.2',
+                     '-l%s' % self.level, '-c%s' % self.chunk] + clean +
+                    bitmap + ['-n%s' % len(unused), '/dev/md%s' % mdnum] +
+                    ['/dev/' + u for u in unused])
+            plan.add(zc.awsrecipes.commands.format(argv), self.create,
+                     (storage, journal, steps, identity, argv),
+                     volume=path, estimate=zc.awsrecipes.plan.estimate(argv))
+            grow = self.finish(
+                plan, storage, journal,
+                dict(identity, steps=steps, done=['create'])) or grow
         else:
             assert self.logical
 
-        path = self.path
-        s('mkdir -p %s' % path)
-        s('mount -t ext3 /dev/vg_%s/data %s' % (self.name, path))
+        if self.cache:
+            self.add_cache(storage, plan)
+
+        if mount:
+            self.mount(plan, data)
+        line = fs.fstab('/dev/mapper/%s-data' % vg, path, self.mount_options)
+        plan.add('update /etc/fstab ' + line, update_fstab, (line, ),
+                 volume=path)
+
+        mds = set(self.mds)
+        if self.bitmap:
+            plan.add('report bitmaps', self.report_bitmaps, (mds, ),
+                     volume=path)
+        if self.tuning:
+            plan.add('tune ' + path, self.tuning.apply,
+                     (path, self.sdvols, mds, data), volume=path)
+        if grow:
+            argv = fs.grow(data, path)
+            plan.add(zc.awsrecipes.commands.format(argv), grows.append,
+                     ((fs.name, data, path), ), volume=path,
+                     estimate=zc.awsrecipes.plan.estimate(
+                         argv, self.size(self.sdvols)),
+                     background=True)
+
+    def mount(self, plan, data, after=None):
+        """Plan mounting the volume's file system
+        """
+        plan.command(['mkdir', '-p', self.path], volume=self.path,
+                     after=after)
+        plan.command(self.fs.mount(data, self.path, self.mount_options),
+                     volume=self.path)
+
+    def report_bitmaps(self, mds):
+        """Report the bitmaps we ended up with
+        """
+        current = zc.awsrecipes.storage.StorageSnapshot()
+        current.read_mdstat(open('/proc/mdstat'))
+        for mdnum in sorted(mds):
+            array = current.arrays[mdnum]
+            if not array.bitmap:
+                where = 'none'
+            elif array.bitmap_file:
+                where = 'file %s, %sK chunks' % (
+                    array.bitmap_file, array.bitmap)
+            else:
+                where = 'internal, %sK chunks' % array.bitmap
+            say('md%s bitmap: %s' % (mdnum, where))
+
+grow_log_path = '/var/log/zim-grow.log'
+
+def grow(volumes):
+    """Grow mounted file systems
 
-def single(mount_point, device):
+    volumes is a sequence of file system types, devices and mount
+    points.  Return whether they were all grown.
+    """
+    ok = True
+    for fs, device, mount_point in volumes:
+        say('growing %s' % mount_point)
+        start = time.time()
+        try:
+            s(*zc.awsrecipes.filesystems.get(fs).grow(device, mount_point))
+        except SystemError, v:
+            say('failed to grow %s: %s' % (mount_point, v))
+            ok = False
+        else:
+            say('grew %s in %.1f seconds'
+                % (mount_point, time.time() - start))
+            zc.awsrecipes.journal.grown(mount_point)
+    return ok
+
+def single(plan, mount_point, device, fs=None, timeout=None, restored=None,
+           **tuning):
+    """Plan setting up a volume on a single device
+
+    We can't tell if the device has a file system until we try to
+    mount it, so the plan allows for making one.
+    """
+    fs = zc.awsrecipes.filesystems.get(fs)
+    options = mount_options(tuning).options(fs)
+    tuning = zc.awsrecipes.tuning.Tuning(**tuning)
     if not os.path.exists(mount_point):
-        s('mkdir -p %s' % mount_point)
-    wait_for_device(device)
-    if not s("mount -t ext3 %s %s" % (device, mount_point),
-             should_raise=False):
-        s("mkfs.ext3 -F "+device)
-        s("echo %s %s ext3 defaults 0 1 >> /etc/fstab"
-          % (device, mount_point))
-        s("mount %s" % mount_point)
+        plan.command(['mkdir', '-p', mount_point], volume=mount_point)
+    mkfs = fs.mkfs(device, force=True)
+    plan.add('%s, or %s' % (
+        zc.awsrecipes.commands.format(fs.mount(device, mount_point, options)),
+        zc.awsrecipes.commands.format(mkfs)),
+             mount_or_mkfs,
+             (mount_point, device, fs, options, timeout, restored),
+             volume=mount_point,
+             estimate=zc.awsrecipes.plan.estimate(
+                 mkfs, zc.awsrecipes.plan.size([device[5:]])))
+    if tuning:
+        plan.add('tune ' + mount_point, tuning.apply,
+                 (mount_point, [device[5:]]), volume=mount_point)
+
+def mount_or_mkfs(mount_point, device, fs, options=(), timeout=None,
+                  restored=None):
+    """Mount a single device, making a file system if it doesn't have one
+
+    If it had one, it's appended to restored.  Either way, it's
+    recorded in /etc/fstab, with the mount options.
+
+    If the device can't be mounted, but blkid finds a signature on it,
+    like a file system of another type or a raid superblock, the mount
+    error is raised, rather than formatting over the data.
+    """
+    wait_for_device(device, timeout)
+    mounted = s(*fs.mount(device, mount_point, options), check=False)
+    if mounted.ok:
+        if restored is not None:
+            restored.append(device)
+        update_fstab(fs.fstab(device, mount_point, options))
+    else:
+        # blkid exits with 2 if it finds nothing on the device:
+        if s('blkid', '-p', device, check=False).status != 2:
+            raise zc.awsrecipes.commands.CommandError(mounted)
+        s(*fs.mkfs(device, force=True), retries=busy_retries)
+        update_fstab(fs.fstab(device, mount_point, options))
+        s('mount', mount_point)
+
+default_stripe_size = 64 # KiB
 
 lvname = re.compile(r"\w+/\w+$").match
-def lvm(mount_point, sdvols):
-    # Make a non-raid logical volume
-    if not os.path.exists(mount_point):
-        s('mkdir -p %s' % mount_point)
+def lvm(plan, mount_point, sdvols, storage, fs=None, timeout=None,
+        stripes=None, stripe_size=None, **tuning):
+    """Plan making a non-raid logical volume
+
+    By default, the volume is linear.  If stripes is given, data are
+    striped across that many of the volumes, in stripe_size chunks.
+    """
+    fs = zc.awsrecipes.filesystems.get(fs)
+    options = mount_options(tuning).options(fs)
+    tuning = zc.awsrecipes.tuning.Tuning(**tuning)
     vg, v = sdvols.pop(0).split('/')
+    striping = []
+    stripe = None
+    if stripes is not None:
+        if stripes == 'all':
+            stripes = len(sdvols)
+        try:
+            stripes = int(stripes)
+        except ValueError:
+            raise ValueError("Bad number", 'stripes', stripes)
+        if not 1 <= stripes <= len(sdvols):
+            raise ValueError("Stripes must be between 1 and the number"
+                             " of volumes", stripes)
+        if stripe_size is None:
+            size = default_stripe_size
+        else:
+            size = parse_chunk(stripe_size, 'Stripe')
+        striping = ['-i', str(stripes), '-I', '%sk' % size]
+        stripe = size, stripes
+    elif stripe_size is not None:
+        raise ValueError("stripe_size without stripes", stripe_size)
+    if not os.path.exists(mount_point):
+        plan.command(['mkdir', '-p', mount_point], volume=mount_point)
+    size = zc.awsrecipes.plan.size(sdvols)
     sdvols = ["/dev/"+pvol for pvol in sdvols]
-    make_sure_physical_volumes_dont_exist(sdvols)
-    for pvol in sdvols:
-        s("pvcreate "+pvol)
-    s("vgcreate %s %s" % (vg, " ".join(sdvols)))
-    s("lvcreate -l +100%%FREE -n %s %s" % (v, vg))
-    s("mkfs -t ext3 /dev/%s/%s" % (vg, v))
-    s("echo /dev/mapper/%s-%s %s ext3 defaults 0 1 >> /etc/fstab"
-      % (vg, v, mount_point))
-    s("mount %s" % mount_point)
-
-def make_sure_physical_volumes_dont_exist(vols):
+    check = plan.add('check %s are unused' % ' '.join(sdvols),
+                     make_sure_physical_volumes_dont_exist,
+                     (sdvols, storage, timeout), volume=mount_point)
+    # The physical volumes can be made at the same time:
+    pvs = [plan.command(['pvcreate', pvol], volume=mount_point,
+                        after=[check],
+                        then=lambda pvol=pvol: storage.add_pv(pvol),
+                        retries=busy_retries)
+           for pvol in sdvols]
+    def added():
+        for pvol in sdvols:
+            storage.add_pv(pvol, vg)
+    plan.command(['vgcreate', vg] + sdvols, volume=mount_point, after=pvs,
+                 then=added)
+    plan.command(['lvcreate', '-l', '+100%FREE'] + striping + ['-n', v, vg],
+                 volume=mount_point)
+    plan.command(fs.mkfs("/dev/%s/%s" % (vg, v), stripe=stripe),
+                 volume=mount_point, size=size, retries=busy_retries)
+    line = fs.fstab("/dev/mapper/%s-%s" % (vg, v), mount_point, options)
+    plan.add('update /etc/fstab ' + line, update_fstab, (line, ),
+             volume=mount_point)
+    plan.command(['mount', mount_point], volume=mount_point)
+    if tuning:
+        def tune():
+            tuning.apply(mount_point, [pvol[5:] for pvol in sdvols],
+                         dm="/dev/%s/%s" % (vg, v))
+        plan.add('tune ' + mount_point, tune, volume=mount_point)
+
+def make_sure_physical_volumes_dont_exist(vols, storage, timeout=None):
+    wait_for_devices(vols, timeout)
     for v in vols:
-        wait_for_device(v)
-    for line in p("pvscan"):
-        line = line.strip()
-        if not line:
-            continue
-        line = line.split()
-        if line[0] == 'PV':
-            if line[1] in vols:
-                raise ValueError(line[1], "already in use")
+        if v in storage.pvs:
+            raise ValueError(v, "already in use")
 
 def ln(mount_point, src):
     if not os.path.exists(os.path.dirname(mount_point)):
-        s('mkdir -p %s' % os.path.dirname(mount_point))
+        s('mkdir', '-p', os.path.dirname(mount_point))
     if not os.path.exists(src):
-        s('mkdir -p %s' % src)
-    s("ln -s %s %s" % (src, mount_point))
+        s('mkdir', '-p', src)
+    s('ln', '-s', src, mount_point)
+
+def wait_for_devices(paths, timeout=None):
+    missing = zc.awsrecipes.devices.wait_for_devices(paths, timeout)
+    if missing:
+        raise SystemError("Devices didn't appear", sorted(missing))
 
-def wait_for_device(path):
-    while not os.path.exists(path):
-        time.sleep(1)
+def wait_for_device(path, timeout=None):
+    wait_for_devices([path], timeout)
 
 def fix_path():
     for p in (path_needed - set(os.environ['PATH'].split(':'))):
         os.environ['PATH'] += ':'+p
 
-def setup_volumes():
+speed_limit = '/proc/sys/dev/raid/speed_limit_%s'
+
+def write(path, value):
+    say('write %s %s' % (path, value))
+    f = open(path, 'w')
+    f.write('%s\n' % value)
+    f.close()
+
+def save_file(path, data):
+    """Replace a file, atomically and durably
+
+    The data are written under a temporary name, synced to disk and
+    renamed, and then the directory is synced.  Readers never see part
+    of the file, and once we return, the new file survives a crash.
+    """
+    f = open(path + '.tmp', 'w')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+fstab = '/etc/fstab'
+fstab_lock = threading.Lock()
+
+def update_fstab(line):
+    """Add a line to /etc/fstab
+
+    A line already there for the same device or mount point is
+    replaced, in place, and any others for them are removed.  If the
+    line is there already, nothing is done.  Otherwise, the file is
+    replaced with save_file.  Volumes set up concurrently update it
+    one at a time.
+    """
+    fstab_lock.acquire()
+    try:
+        device, mount_point = line.split()[:2]
+        try:
+            f = open(fstab)
+        except IOError:
+            old = []
+        else:
+            old = f.readlines()
+            f.close()
+        if old and not old[-1].endswith('\n'):
+            old[-1] += '\n'
+
+        new = []
+        for entry in old:
+            words = entry.split()
+            if (words and not words[0].startswith('#') and
+                (words[0] == device or words[1:2] == [mount_point])):
+                if line + '\n' not in new:
+                    new.append(line + '\n')
+            else:
+                new.append(entry)
+        if line + '\n' not in new:
+            new.append(line + '\n')
+        if new == old:
+            return
+
+        say('update %s %s' % (fstab, line))
+        save_file(fstab, ''.join(new))
+    finally:
+        fstab_lock.release()
+
+def mount_options(options):
+    """Remove mount options from a volume's options, returning a Mount
+    """
+    return zc.awsrecipes.mounts.Mount(**dict(
+        (name, options.pop(name)) for name in zc.awsrecipes.mounts.options
+        if name in options))
+
+report_path = '/etc/zim/volumes-setup.json'
+
+def setup_volumes(jobs=1, device_timeout=None,
+                  resync_speed_min=None, resync_speed_max=None,
+                  textfile=None, prewarm=False, prewarm_jobs=4,
+                  prewarm_rate=None):
     """Set up md (raid) and lvm modules on a new machine
+
+    Setting up is planned first, and then steps that don't depend on
+    each other, like those for different volumes, are taken
+    concurrently by up to jobs workers.
+
+    If device_timeout is given, give up if devices haven't appeared
+    after that many seconds.
+
+    The resync speed limits, in KB/sec, are used while setting up and
+    then restored.
+
+    A report of how long each phase, volume and command took is saved
+    in /etc/zim/volumes-setup.json, whether or not setting up
+    succeeds.  If textfile is given, metrics are also saved there, for
+    the Prometheus node exporter's textfile collector.
+
+    If the configuration and its devices haven't changed since the
+    last successful setup, volumes are just activated and mounted.
+
+    File systems of volumes we've added devices to are mounted right
+    away and grown afterwards, in the background.
+
+    If prewarm is true, devices with existing data, which may have
+    been restored from snapshots, are read in the background by
+    prewarm_jobs threads, at up to prewarm_rate bytes per second.
     """
 
     fix_path()
 
+    report = zc.awsrecipes.timing.Report()
+    grows = []
+    try:
+        with report.recording():
+            saved = []
+            try:
+                for name, value in (('min', resync_speed_min),
+                                    ('max', resync_speed_max)):
+                    if value is not None:
+                        path = speed_limit % name
+                        saved.append((path, open(path).read().strip()))
+                        write(path, value)
+
+                with report.phase('config') as phase:
+                    lines = read_config()
+                    phase['volumes'] = len(lines)
+                    fingerprint = zc.awsrecipes.applied.fingerprint(lines)
+                applied = zc.awsrecipes.applied.load()
+                journal = zc.awsrecipes.journal.Journal.load()
+                if (zc.awsrecipes.applied.unchanged(applied, fingerprint)
+                    and activate(applied, lines, report)):
+                    # Finish warming and growing that was interrupted:
+                    restored = zc.awsrecipes.prewarm.unfinished(
+                        sorted('/dev/' + name
+                               for name in fingerprint['devices']))
+                    grows.extend(journal.grows())
+                else:
+                    restored = []
+                    plan = zc.awsrecipes.plan.Plan()
+                    storage = _setup_volumes(
+                        plan, lines, device_timeout, report, restored,
+                        grows, journal)
+                    with report.phase('jobs'):
+                        plan.run(jobs, report)
+                    zc.awsrecipes.applied.save(fingerprint, storage)
+            finally:
+                for path, value in saved:
+                    write(path, value)
+
+            os.rename('/etc/zim/volumes', '/etc/zim/volumes-setup')
+    finally:
+        save_report(report, textfile)
+
+    if grows:
+        say('growing %s in the background, see %s'
+            % (' '.join(path for fs, device, path in grows), grow_log_path))
+        zc.awsrecipes.commands.background(grow_log_path, grow, grows)
+
+    if prewarm and restored:
+        restored.sort()
+        say('prewarming %s in the background' % ' '.join(restored))
+        zc.awsrecipes.prewarm.start(restored, prewarm_jobs, prewarm_rate)
+
+def plan_volumes(jobs=1, device_timeout=0):
+    """Show the plan for setting up volumes, without setting them up
+
+    Storage is scanned, but nothing is changed.  Arrays that aren't
+    assembled yet are shown as steps, and assumed to hold the volume
+    groups we'd have put on them.  The time taking the steps should
+    take with jobs workers is estimated.
+
+    Devices are waited for for up to device_timeout seconds.  Devices
+    that haven't appeared by then are shown as steps that wait for
+    them, and are assumed to be new.
+    """
+    fix_path()
+    lines = read_config()
+    fingerprint = zc.awsrecipes.applied.fingerprint(lines)
+    applied = zc.awsrecipes.applied.load()
+    if (zc.awsrecipes.applied.unchanged(applied, fingerprint) and
+        zc.awsrecipes.applied.assembled(applied)):
+        say('volumes unchanged since set up, so they would just be'
+            ' activated and mounted')
+        return
+    plan = zc.awsrecipes.plan.Plan()
+    _setup_volumes(plan, lines, device_timeout, zc.awsrecipes.timing.Report(),
+                   [], [], zc.awsrecipes.journal.Journal.load(True), True)
+    plan.show(jobs)
+
+def save_report(report, textfile=None):
+    try:
+        report.save(report_path)
+        if textfile:
+            report.save_textfile(textfile)
+    except EnvironmentError, v:
+        say("Couldn't save the timing report: %s" % v)
+
+# Options allowed for each kind of volume:
+from zc.awsrecipes.tuning import options as tuning_options
+from zc.awsrecipes.mounts import options as mount_option_names
+single_options = (set(('fs', ) + tuning_options + mount_option_names) -
+                  set(('stripe_cache', )))
+lvm_options = single_options | set(('stripes', 'stripe_size'))
+raid_options = set(('fs', 'raid', 'chunk', 'cache', 'cache_mode', 'bitmap',
+                    'bitmap_chunk') + tuning_options + mount_option_names)
+
+def parse_line(line):
+    """Parse a line from /etc/zim/volumes
+
+    Return the mount point, the volumes and a dictionary of options.
+    Options are words of the form name=value.
+    """
+    words = line.split()
+    mount_point = words.pop(0)
+    sdvols = [w for w in words if '=' not in w]
+    options = dict(w.split('=', 1) for w in words if '=' in w)
+    return mount_point, sdvols, options
+
+def check_options(options, allowed, line):
+    unknown = set(options) - allowed
+    if unknown:
+        raise ValueError("Unknown options", sorted(unknown), line)
+
+def read_config(path='/etc/zim/volumes'):
     # Get what we want from the ZK tree
+    f = open(path)
+    lines = [line.strip() for line in f if line.strip()]
+    f.close()
+    return lines
+
+def mounted():
+    """Return the set of mount points in use
+    """
+    f = open('/proc/mounts')
+    mount_points = set(line.split()[1] for line in f if line.strip())
+    f.close()
+    return mount_points
+
+def activate(applied, lines, report):
+    """Activate and mount volumes that have been set up before
+
+    Return False if the machine isn't as we left it, and volumes need
+    to be set up the long way.
+    """
+    with report.phase('activate'):
+        if not zc.awsrecipes.applied.assembled(applied):
+            say('arrays not assembled as set up')
+            return False
+        say('volumes unchanged since set up')
+        for vg in applied['vgs']:
+            if not s('vgchange', '-a', 'y', vg, check=False).ok:
+                return False
+        in_use = mounted()
+        for line in lines:
+            mount_point, sdvols, options = parse_line(line)
+            if mount_point in in_use:
+                continue
+            if sdvols[0][0] == '/':
+                if not os.path.exists(mount_point):
+                    ln(mount_point, sdvols[0])
+            elif len(sdvols) == 1 or lvname(sdvols[0]):
+                # In fstab.  Instance-store devices come back blank
+                # after the instance is stopped and started, under the
+                # same names, so if we can't mount one, set it up again:
+                if not s('mount', mount_point, check=False).ok:
+                    say("couldn't mount " + mount_point)
+                    return False
+            else:
+                fs = zc.awsrecipes.filesystems.get(options.get('fs'))
+                if not os.path.exists(mount_point):
+                    s('mkdir', '-p', mount_point)
+                s(*fs.mount('/dev/vg_%s/data' % sdvols[0][:3], mount_point,
+                            mount_options(options).options(fs)))
+        return True
+
+def _setup_volumes(plan, lines, device_timeout, report, restored, grows,
+                   journal, dry_run=False):
+    """Plan setting up volumes
+
+    Storage is scanned and the arrays found on our devices assembled
+    (or, if dry_run is true, assumed to be) first, as the plan depends
+    on what's there.  The storage snapshot is returned.
+    """
     logical_volumes = {}
     expected_sdvols = set()
-    f = open('/etc/zim/volumes')
-    for line in f:
-        line = line.strip()
-        if not line:
-            continue
-        sdvols = line.split()
-        mount_point = sdvols.pop(0)
+    cache_devices = set()
+    lvms = []
+    for line in lines:
+        mount_point, sdvols, options = parse_line(line)
         if len(sdvols) == 1:
             dev = sdvols[0]
             if dev[0] == '/':
-                ln(mount_point, dev)
+                if options:
+                    raise ValueError("Links don't take options", line)
+                plan.add(zc.awsrecipes.commands.format(
+                    ['ln', '-s', dev, mount_point]), ln, (mount_point, dev),
+                         volume=mount_point)
             else:
-                single(mount_point, '/dev/'+dev)
+                check_options(options, single_options, line)
+                single(plan, mount_point, '/dev/'+dev,
+                       timeout=device_timeout, restored=restored,
+                       **options)
             continue
 
         if len(sdvols) < 1:
             raise ValueError(line)
 
         if lvname(sdvols[0]):
-            lvm(mount_point, sdvols)
+            check_options(options, lvm_options, line)
+            lvms.append((mount_point, sdvols, options))
             continue
 
 
-        # RAID10:
+        # RAID10 (or 0):
+        check_options(options, raid_options, line)
         assert len(set(sdvol[:3] for sdvol in sdvols)) == 1, (
             "Multiple device prefixes")
         sdprefix = sdvols[0][:3]
-        logical_volumes[sdprefix] = LogicalVolume(
-            sdprefix, sdvols, mount_point)
+        lv = logical_volumes[sdprefix] = LogicalVolume(
+            sdprefix, sdvols, mount_point, **options)
         expected_sdvols.update(sdvols)
+        cache_devices.update(lv.cache)
 
+    absent = set()
     if logical_volumes:
 
         # Wait for all of our expected sd volumes to appear. (They may be
-        # attaching.)
-        for v in expected_sdvols:
-            wait_for_device('/dev/' + v)
-
-        # The volumes may have been set up before on a previous machine.
-        # Scan for them:
-        s('mdadm --examine --scan >>/etc/mdadm.conf')
-        f = open('/etc/mdadm.conf')
-        if f.read().strip():
-            s('mdadm -A --scan')
-        f.close()
+        # attaching.)  When planning, devices that don't appear are shown
+        # as steps, as they would be waited for:
+        with report.phase('wait for devices') as phase:
+            phase['devices'] = len(expected_sdvols | cache_devices)
+            paths = ['/dev/' + v for v in expected_sdvols | cache_devices]
+            if dry_run:
+                missing = zc.awsrecipes.devices.wait_for_devices(
+                    paths, device_timeout)
+                absent = set(path[5:] for path in missing)
+                for lv in logical_volumes.values():
+                    waiting = sorted('/dev/' + v for v in
+                                     (lv.sdvols | set(lv.cache)) & absent)
+                    if waiting:
+                        plan.add('wait for ' + ' '.join(waiting),
+                                 wait_for_devices, (waiting, ),
+                                 volume=lv.path)
+            else:
+                wait_for_devices(paths, device_timeout)
 
-        # Read /proc/mdstat to find out about existing raid volumes:
-        mdstat = re.compile(r'md(\w+) : (\w+) (\w+) (.+)$').match
-        mdstatsd = re.compile(r'(sd(\w+))\[\d+\](\(F\))?$').match
-        for line in open('/proc/mdstat'):
-            if not line.strip():
-                continue
-            m = mdstat(line)
-            if not m:
-                assert (line.startswith('Personalities') or
-                        line.startswith(' ') or
-                        line.startswith('unused devices')), (
-                    "unexpected line", line
-                    )
-                continue
-            mdnum, status, rtype, data = m.group(1, 2, 3, 4)
-            data = [mdstatsd(d).groups() for d in data.strip().split()]
+    # Entries for volumes that are no longer set up will never be
+    # resumed:
+    configured = set(lv.path for lv in logical_volumes.values())
+    for mount_point in sorted(set(journal.entries) - configured):
+        say('dropping the journal entry for %s, no longer configured'
+            % mount_point)
+        journal.drop(mount_point)
 
-            assert not [d for d in data if d[2]], (
-                "Failed volume", line
-                )
+    if not (logical_volumes or lvms):
+        return None
 
-            data = [d[0] for d in data]
-            if not [d for d in data if d in expected_sdvols]:
-                # Hm, not one weore interested in.
-                print 'skipping', line
-                continue
+    # Find out about existing raid volumes and logical volumes, once.
+    # The volumes may have been set up before on a previous machine,
+    # so we look for md superblocks on them at the same time:
+    storage = zc.awsrecipes.storage.StorageSnapshot()
+    with report.phase('scan') as phase:
+        arrays = storage.scan(examine=expected_sdvols - absent)
+        phase['devices'] = len(storage.devices)
+        phase['arrays'] = len(storage.arrays)
+        phase['physical_volumes'] = len(storage.pvs)
 
-            assert not [d for d in data if d not in expected_sdvols], (
-                "Unexpected volume", data
-                )
+    if logical_volumes:
+        with report.phase('assemble') as phase:
+            phase['arrays'] = len(arrays)
+            if arrays and dry_run:
+                assume_assembled(arrays, storage, plan, logical_volumes)
+            elif arrays:
+                update_mdadm_conf([line for line, devices in arrays])
+                assemble(arrays, storage)
 
-            assert status == 'active', status
-            assert rtype == 'raid10', rtype
+    for mount_point, sdvols, options in lvms:
+        lvm(plan, mount_point, sdvols, storage, timeout=device_timeout,
+            **options)
 
-            logical_volumes[data[0][:3]].add_md(mdnum, data)
+    if logical_volumes:
 
-        # Scan for logical volumes:
-        lv_pat = re.compile('Found volume group "vg_(sd\w+)"').search
-        for line in p('vgscan'):
-            m = lv_pat(line)
-            if not m:
-                continue
-            name = m.group(1)
-            if name in logical_volumes:
-                logical_volumes[name].has_logical_volume()
-
-        # Record the physical volums in each logical_volume so we can see
-        # if any are missing:
-        PV = re.compile("PV /dev/md(\w+) +VG vg_(sd\w+) ").search
-        for line in p("pvscan"):
-            m = PV(line)
-            if not m:
-                continue
-            mdnum, vgname = m.groups()
-            logical_volumes[vgname].pvs.add(mdnum)
+        with report.phase('discover'):
+            discover(storage, logical_volumes, expected_sdvols, restored,
+                     plan)
 
         # Finally, create any missing raid volumes and logical volumes
         for lv in logical_volumes.values():
-            lv.setup()
+            lv.reserve_md(storage)
+        for lv in logical_volumes.values():
+            lv.plan(plan, storage, grows, journal)
+
+    return storage
 
-    os.rename('/etc/zim/volumes', '/etc/zim/volumes-setup')
+mdadm_conf = '/etc/mdadm.conf'
+
+def update_mdadm_conf(lines):
+    """Add ARRAY lines to mdadm.conf
+
+    Lines already there for the same arrays (by UUID) are replaced.
+    The file is replaced with save_file.
+    """
+    uuids = set(zc.awsrecipes.storage.array_field(line, 'UUID')
+                for line in lines)
+    try:
+        f = open(mdadm_conf)
+    except IOError:
+        old = []
+    else:
+        old = f.readlines()
+        f.close()
+
+    # Group ARRAY lines with their continuation lines:
+    entries = []
+    for line in old:
+        if line[:1].isspace() and entries and entries[-1][0]:
+            entries[-1].append(line)
+        else:
+            entries.append([line.startswith('ARRAY') and line, line])
+    kept = [entry[1:] for entry in entries
+            if not (entry[0] and zc.awsrecipes.storage.array_field(
+                ' '.join(entry[1:]), 'UUID') in uuids)]
+
+    save_file(mdadm_conf, ''.join(''.join(entry) for entry in kept) +
+              ''.join(line + '\n' for line in lines))
+
+def assemblies(arrays, storage):
+    """Return the commands to assemble arrays found by examining devices
+
+    Each array is assembled by UUID from the devices it was found on.
+    Arrays found on fewer devices than they were made of, and so not
+    all ours, or already assembled, are skipped.  The commands are
+    returned with the arrays' ARRAY lines and devices.
+    """
+    result = []
+    for line, devices in arrays:
+        size = zc.awsrecipes.storage.array_field(line, 'num-devices')
+        if [d for d in devices if d in storage.members]:
+            continue
+        if size is not None and len(devices) < int(size):
+            say('skipping incomplete array %s on %s'
+                % (line.split()[1], ' '.join(devices)))
+            continue
+        result.append((['mdadm', '--assemble', line.split()[1],
+                        '--uuid=' + zc.awsrecipes.storage.array_field(
+                            line, 'UUID')] + ['/dev/' + d for d in devices],
+                       line, devices))
+    return result
+
+def assemble(arrays, storage):
+    """Assemble arrays found by examining devices, concurrently
+
+    The arrays assembled, and the physical volumes on them, are added
+    to storage.
+    """
+    jobs = [argv for argv, line, devices in assemblies(arrays, storage)]
+    if len(jobs) > 1:
+        pool = Pool(len(jobs))
+    else:
+        pool = Serial()
+    for argv in jobs:
+        pool.submit(s, *argv)
+    pool.join()
+
+    if jobs:
+        # The LVM report we have was made before these arrays were
+        # running, so read what it says about them:
+        before = set(storage.arrays)
+        storage.read_mdstat(open('/proc/mdstat'))
+        paths = sorted(storage.arrays[mdnum].path
+                       for mdnum in storage.arrays if mdnum not in before)
+        if paths:
+            storage.read_lvm(paths)
+
+def assume_assembled(arrays, storage, plan, logical_volumes):
+    """Plan assembling arrays, and add them to storage as if they were
+
+    We can't see the physical volumes on arrays that aren't running,
+    so those of our volumes are assumed to be in their volume groups.
+    """
+    for argv, line, devices in assemblies(arrays, storage):
+        lv = logical_volumes.get(devices[0][:3])
+        plan.command(argv, volume=lv and lv.path)
+        level = zc.awsrecipes.storage.array_field(line, 'level')
+        array = zc.awsrecipes.storage.Array(
+            storage.allocate_md(), 'active', level, devices)
+        storage.add_array(array)
+        if lv is not None:
+            storage.add_pv(array.path, 'vg_' + lv.name)
+
+def discover(storage, logical_volumes, expected_sdvols, restored, plan):
+    """Find the existing arrays and volume groups of logical volumes
+
+    Members of existing arrays are added to restored.  Activating
+    existing volume groups is planned.
+    """
+    for mdnum, array in sorted(storage.arrays.items()):
+        data = array.members
+        assert not array.failed, ("Failed volume", mdnum, data)
+
+        if not [d for d in data if d in expected_sdvols]:
+            # Hm, not one weore interested in.
+            say('skipping md%s %s' % (mdnum, ' '.join(data)))
+            continue
+
+        assert not [d for d in data if d not in expected_sdvols], (
+            "Unexpected volume", data
+            )
+
+        lv = logical_volumes[data[0][:3]]
+        assert array.status == 'active', array.status
+        assert array.level == 'raid' + lv.level, array.level
+
+        lv.add_md(mdnum, data)
+        restored.extend('/dev/' + d for d in data)
+
+    # Record the physical volums in each logical_volume so we
+    # can see if any are missing:
+    for pv, vg in storage.pvs.items():
+        if (pv.startswith('/dev/md') and vg and
+            vg.startswith('vg_') and vg[3:] in logical_volumes):
+            logical_volumes[vg[3:]].pvs.add(pv[7:])
+
+    # Activate existing logical volumes:
+    for vg in sorted(storage.vgs):
+        if vg.startswith('vg_') and vg[3:] in logical_volumes:
+            logical_volumes[vg[3:]].has_logical_volume(storage, plan)
 
 def setup_volumes_main(args=None):
     if args is None:
         args = sys.argv[1:]
-    assert not args
 
-    setup_volumes()
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-j', '--jobs', type='int', default=1,
+        help='Number of steps to take concurrently (default 1)')
+    parser.add_option(
+        '--plan', action='store_true',
+        help="Show the steps setting up would take, and how long they"
+        " should take, without taking them")
+    parser.add_option(
+        '--status', action='store_true',
+        help="Show the volumes set up, with the arrays and devices under"
+        " them, and how busy the devices are, without setting up")
+    parser.add_option(
+        '--status-interval', type='float', metavar='SECONDS', default=1,
+        help="With --status, how long to measure device activity over"
+        " (default 1, 0 to not measure)")
+    parser.add_option(
+        '--status-format', type='choice',
+        choices=zc.awsrecipes.status.formats, default='text',
+        help="With --status, show the status as %s (default text)"
+        % ', '.join(zc.awsrecipes.status.formats))
+    parser.add_option(
+        '--record', metavar='PATH',
+        help="Save what the storage probes output in PATH, to replay in"
+        " tests, without setting up")
+    parser.add_option(
+        '-t', '--device-timeout', type='float',
+        help="Seconds to wait for devices to appear (default: forever)")
+    parser.add_option(
+        '--resync-speed-min', type='int', metavar='KB/SEC',
+        help="Minimum raid resync speed while setting up")
+    parser.add_option(
+        '--resync-speed-max', type='int', metavar='KB/SEC',
+        help="Maximum raid resync speed while setting up")
+    parser.add_option(
+        '--prometheus-textfile', metavar='PATH',
+        help="Also save timing metrics for the Prometheus node exporter's"
+        " textfile collector in PATH, or, with --status, save the status"
+        " there")
+    parser.add_option(
+        '--watch', action='store_true',
+        help="After setting up, keep running, and add devices attached"
+        " later to the raid volumes they're named like")
+    parser.add_option(
+        '--debounce', type='float', metavar='SECONDS',
+        default=zc.awsrecipes.watch.debounce,
+        help="With --watch, how long to wait after a device is attached"
+        " for more before adding them (default %s)"
+        % zc.awsrecipes.watch.debounce)
+    parser.add_option(
+        '--prewarm', action='store_true',
+        help="Read every block of devices with existing data, in the"
+        " background, so blocks restored from snapshots are fetched"
+        " before they're needed")
+    parser.add_option(
+        '--prewarm-jobs', type='int', default=4,
+        help='Number of devices to prewarm concurrently (default 4)')
+    parser.add_option(
+        '--prewarm-rate', type='float', metavar='MB/SEC',
+        help="Limit on the total rate of prewarming reads")
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+
+    if options.plan:
+        return plan_volumes(options.jobs, options.device_timeout or 0)
+
+    if options.record:
+        return zc.awsrecipes.replay.save(zc.awsrecipes.replay.record(),
+                                         options.record)
+
+    if options.status:
+        return zc.awsrecipes.status.report(
+            options.status_interval, options.status_format,
+            options.prometheus_textfile)
+
+    # When watching, we may have set up already, before a restart.
+    if not (options.watch and not os.path.exists('/etc/zim/volumes')):
+        setup_volumes(options.jobs, options.device_timeout,
+                      options.resync_speed_min, options.resync_speed_max,
+                      options.prometheus_textfile, options.prewarm,
+                      options.prewarm_jobs,
+                      options.prewarm_rate and options.prewarm_rate * (1 << 20))
+
+    if options.watch:
+        zc.awsrecipes.watch.HotAttach(options.debounce).run()
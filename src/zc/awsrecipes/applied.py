@@ -0,0 +1,86 @@
+"""Remember what was set up, so unchanged machines can skip scanning
+
+After a successful setup, we save a fingerprint of the configuration
+and of the devices it names (with their sizes), along with the arrays
+and volume groups we ended up with.  When a later run finds the same
+configuration and devices, and the arrays already assembled, the md
+and LVM scans are skipped, and volumes are just activated and mounted.
+"""
+import json
+import zc.awsrecipes
+import zc.awsrecipes.storage
+
+path = '/etc/zim/volumes-applied'
+
+def fingerprint(lines):
+    """Fingerprint a configuration and the devices it names
+
+    Devices that don't exist (yet) have a size of None.
+    """
+    devices = {}
+    for line in lines:
+        mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+        for name in sdvols:
+            if name[0] == '/' or zc.awsrecipes.lvname(name):
+                continue
+            try:
+                devices[name] = zc.awsrecipes.storage.device_size(name)
+            except EnvironmentError:
+                devices[name] = None
+    return dict(config=list(lines), devices=devices)
+
+def layout(fingerprint, storage):
+    """Return the arrays and volume groups made from our devices
+    """
+    arrays = {}
+    for mdnum, array in storage.arrays.items():
+        if [name for name in array.members
+            if name in fingerprint['devices']]:
+            arrays[mdnum] = sorted(array.members)
+    vgs = set()
+    for pv, vg in storage.pvs.items():
+        name = pv.rsplit('/', 1)[-1]
+        if vg and (name in fingerprint['devices'] or
+                   (name.startswith('md') and name[2:] in arrays)):
+            vgs.add(vg)
+    return dict(arrays=arrays, vgs=sorted(vgs))
+
+def load():
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+    finally:
+        f.close()
+
+def save(fingerprint, storage):
+    data = dict(fingerprint)
+    if storage is not None:
+        data.update(layout(fingerprint, storage))
+    else:
+        data.update(arrays={}, vgs=[])
+    zc.awsrecipes.save_file(path, json.dumps(
+        data, indent=2, sort_keys=True, separators=(',', ': ')) + '\n')
+
+def unchanged(applied, fingerprint):
+    return (applied is not None and
+            applied['config'] == fingerprint['config'] and
+            applied['devices'] == fingerprint['devices'] and
+            None not in fingerprint['devices'].values())
+
+def assembled(applied):
+    """Are the arrays we set up assembled, as we left them?
+    """
+    storage = zc.awsrecipes.storage.StorageSnapshot()
+    storage.read_mdstat(open('/proc/mdstat'))
+    for mdnum, members in applied['arrays'].items():
+        array = storage.arrays.get(mdnum)
+        if (array is None or array.failed or
+            sorted(array.members) != members):
+            return False
+    return True
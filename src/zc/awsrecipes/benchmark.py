@@ -0,0 +1,256 @@
+"""Benchmark setting up volumes on a simulated machine
+
+The simulated machine used by the tests is given realistic command
+latencies and devices that attach one at a time.  We generate
+configurations with many volumes and measure how long setting them up
+takes, how many commands are run and how many times storage is
+scanned, so changes meant to speed up provisioning can be checked
+without real EBS volumes.
+
+Run it with::
+
+  benchmark-volumes --groups 8 --members 8 --singles 20
+
+We also time discovering storage, by replaying what probes output on
+large layouts, generated like bundles recorded on real hosts, or
+recorded ones::
+
+  benchmark-volumes --discovery --groups 50 --members 8
+  benchmark-volumes --replay host.json
+
+The simulated machine is the tests', so this module needs the test
+dependencies, which the benchmark-volumes script requires with the
+``test`` extra.  Install ``zc.awsrecipes[test]`` to use it.
+"""
+from zope.testing import setupstack
+import optparse
+import os
+import StringIO
+import sys
+import time
+import zc.awsrecipes
+import zc.awsrecipes.replay
+import zc.awsrecipes.tests
+
+# Device-name prefixes for raid groups, one per group:
+group_prefixes = ['sd' + c for c in 'bcdefghijklmnopqrstuvwxyz']
+
+def generate(groups=1, members=4, singles=0, lvms=0, fs=None):
+    """Generate a configuration
+
+    Return the devices needed and the text of /etc/zim/volumes.  There
+    are groups raid volumes of members devices each, singles single
+    volumes and lvms (non-raid) LVM volumes of 2 devices each.
+    """
+    if groups > len(group_prefixes):
+        raise ValueError("Too many groups", groups)
+    if fs:
+        options = ' fs=' + fs
+    else:
+        options = ''
+    sds = []
+    lines = []
+    for i in range(singles):
+        sd = 'xvs%s' % i
+        sds.append(sd)
+        lines.append('/mnt/single%s %s%s' % (i, sd, options))
+    for i in range(lvms):
+        vols = ['xvl%s_%s' % (i, j) for j in range(2)]
+        sds.extend(vols)
+        lines.append('/mnt/lvm%s lvm%s/data %s%s'
+                     % (i, i, ' '.join(vols), options))
+    for prefix in group_prefixes[:groups]:
+        vols = ['%s%s' % (prefix, j + 1) for j in range(members)]
+        sds.extend(vols)
+        lines.append('/mnt/%s %s%s' % (prefix, ' '.join(vols), options))
+    return sds, ''.join(line + '\n' for line in lines)
+
+class Test:
+    # Stand-in for a doctest, to hold clean-up functions.
+
+    def __init__(self):
+        self.globs = {}
+
+def run(sds, config, jobs=1, scale=.01, attach_interval=0):
+    """Set up volumes on a simulated machine
+
+    Command latencies are multiplied by scale.  If attach_interval is
+    given, the devices attach that many (unscaled) seconds apart.
+
+    Return the wall-clock time taken, the number of commands run and
+    the number of storage scans.
+    """
+    test = Test()
+    path = os.environ['PATH']
+    stdout = sys.stdout
+    try:
+        volumes = zc.awsrecipes.tests.FauxVolumes(test)
+        volumes.init(sds)
+        volumes.scale = scale
+        volumes.etc_zim_volumes = config
+        if attach_interval:
+            volumes.attach(attach_interval * scale)
+        sys.stdout = StringIO.StringIO()
+        start = time.time()
+        zc.awsrecipes.setup_volumes(jobs)
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+        setupstack.tearDown(test)
+        os.environ['PATH'] = path
+    return dict(seconds=seconds, commands=len(volumes.commands),
+                scans=volumes.scans)
+
+def layout(arrays=4, members=4, failed=0, resyncing=0):
+    """Generate a bundle of what storage probes output
+
+    It's like one recorded on a host with arrays raid10 arrays of
+    members NVMe devices each, with a volume group on each.  The first
+    failed arrays have a failed member and are recovering onto a new
+    one, and the next resyncing arrays are resyncing.
+    """
+    mdstat = ['Personalities : [raid10] \n']
+    sizes = {'nvme0n1': '16777216\n'}
+    pvs = []
+    examine = []
+    n = 1
+    for md in range(arrays):
+        names = ['nvme%sn1' % (n + i) for i in range(members)]
+        n += members
+        for name in names:
+            sizes[name] = '209715200\n'
+        sizes['md%s' % md] = '%s\n' % (209715200 * members // 2)
+        states = [name + '[%s]' % i for i, name in enumerate(names)]
+        blocks = 104791040 * members // 2
+        if md < failed:
+            states[1] += '(F)'
+            states.append('nvme%sn1[%s]' % (n, members))
+            sizes['nvme%sn1' % n] = '209715200\n'
+            names.append('nvme%sn1' % n)
+            n += 1
+            progress = ('      [==>..................]  recovery = 12.6%'
+                        ' (13211648/104791040) finish=7.6min'
+                        ' speed=200000K/sec\n')
+            health = '[%s/%s] [U_%s]' % (members, members - 1,
+                                         'U' * (members - 2))
+        elif md < failed + resyncing:
+            progress = ('      [>....................]  resync =  3.4%'
+                        ' (3562880/104791040) finish=8.4min'
+                        ' speed=200000K/sec\n')
+            health = '[%s/%s] [%s]' % (members, members, 'U' * members)
+        else:
+            progress = ''
+            health = '[%s/%s] [%s]' % (members, members, 'U' * members)
+        mdstat.append('md%s : active raid10 %s\n' % (
+            md, ' '.join(reversed(states))))
+        mdstat.append('      %s blocks super 1.2 512K chunks 2 near-copies'
+                      ' %s\n' % (blocks, health))
+        mdstat.append(progress)
+        mdstat.append('      bitmap: 1/1 pages [4KB], 65536KB chunk\n\n')
+        pvs.append('{"pv_name":"/dev/md%s", "vg_name":"vg_md%s"}' % (md, md))
+        examine.append(
+            'ARRAY /dev/md/%s  level=raid10 metadata=1.2 num-devices=%s'
+            ' UUID=%08x:00000000:00000000:00000000 name=benchmark:%s\n'
+            '   devices=%s\n' % (md, members, md, md,
+                                 ','.join('/dev/' + name for name in names)))
+    mdstat.append('unused devices: <none>\n')
+    return dict(
+        mdstat=''.join(mdstat),
+        sizes=sizes,
+        lvm='  {\n      "report": [\n          {\n              "pv": [\n'
+        + ',\n'.join('                  ' + pv for pv in pvs)
+        + '\n              ]\n          }\n      ]\n  }\n',
+        examined=sorted(name for name in sizes if not name.startswith('md')),
+        examine='mdadm: No md superblock detected on /dev/nvme0n1.\n'
+        + ''.join(examine),
+        )
+
+def discover(bundle, repeat=10):
+    """Time discovering storage from a bundle of probe output
+
+    Return the average seconds taken, and the numbers of arrays and
+    array members found.
+    """
+    start = time.time()
+    for i in range(repeat):
+        storage, arrays = zc.awsrecipes.replay.replay(bundle)
+    seconds = (time.time() - start) / repeat
+    return dict(seconds=seconds, arrays=len(storage.arrays),
+                members=len(storage.members))
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--groups', type='int', default=4,
+                      help='Number of raid volumes (default 4)')
+    parser.add_option('--members', type='int', default=4,
+                      help='Devices in each raid volume (default 4)')
+    parser.add_option('--singles', type='int', default=0,
+                      help='Number of single volumes')
+    parser.add_option('--lvms', type='int', default=0,
+                      help='Number of non-raid LVM volumes')
+    parser.add_option('--fs', help='File system (default ext3)')
+    parser.add_option(
+        '-j', '--jobs', type='int', action='append',
+        help='Concurrent jobs to try.  Can be repeated (default 1)')
+    parser.add_option(
+        '--scale', type='float', default=.01,
+        help='Factor applied to simulated latencies (default .01)')
+    parser.add_option(
+        '--attach-interval', type='float', default=0, metavar='SECONDS',
+        help='Simulated time between device attachments')
+    parser.add_option(
+        '--discovery', action='store_true',
+        help='Time discovering storage on a generated layout, with'
+        ' --groups arrays of --members devices, rather than setting up')
+    parser.add_option(
+        '--failed', type='int', default=0,
+        help='With --discovery, number of arrays recovering from a failure')
+    parser.add_option(
+        '--resyncing', type='int', default=0,
+        help='With --discovery, number of arrays resyncing')
+    parser.add_option(
+        '--replay', action='append', metavar='PATH',
+        help='Time discovering storage from a recorded bundle of probe'
+        ' output.  Can be repeated')
+    parser.add_option(
+        '--repeat', type='int', default=10,
+        help='Times to repeat each discovery (default 10)')
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+    if options.scale <= 0:
+        parser.error('the scale must be positive')
+
+    if options.discovery or options.replay:
+        bundles = []
+        if options.discovery:
+            bundles.append(('generated', layout(
+                options.groups, options.members, options.failed,
+                options.resyncing)))
+        for path in options.replay or ():
+            bundles.append((path, zc.awsrecipes.replay.load(path)))
+        print '%7s %8s %10s  %s' % ('arrays', 'members', 'ms', 'layout')
+        for name, bundle in bundles:
+            result = discover(bundle, options.repeat)
+            print '%7s %8s %10.3f  %s' % (
+                result['arrays'], result['members'],
+                result['seconds'] * 1000, name)
+        return
+
+    sds, config = generate(options.groups, options.members,
+                           options.singles, options.lvms, options.fs)
+    print '%s devices, %s volumes' % (len(sds), len(config.splitlines()))
+    print '%6s %10s %10s %9s %6s' % (
+        'jobs', 'seconds', 'simulated', 'commands', 'scans')
+    for jobs in options.jobs or [1]:
+        result = run(sds, config, jobs, options.scale,
+                     options.attach_interval)
+        print '%6s %10.3f %10.1f %9s %6s' % (
+            jobs, result['seconds'], result['seconds'] / options.scale,
+            result['commands'], result['scans'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Run commands
+
+Commands are given as argument lists and run without a shell.  Output
+is read from a pipe as it's produced, and each run is described by a
+Result giving the exit status, how long the command took and what it
+output.
+"""
+import os
+import pipes
+import re
+import subprocess
+import sys
+import threading
+import time
+import zc.awsrecipes
+
+# Failures worth another try, because the device will be free soon:
+transient = re.compile(r'busy', re.I).search
+
+retry_delay = 1 # seconds
+
+# Functions to call with the result of each command run:
+listeners = []
+
+def format(argv):
+    return ' '.join(pipes.quote(arg) for arg in argv)
+
+class Result:
+
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.status = None
+        self.output = ''
+        self.duration = None
+        self.attempts = 0
+        self.timed_out = False
+
+    @property
+    def command(self):
+        return format(self.argv)
+
+    @property
+    def ok(self):
+        return self.status == 0 and not self.timed_out
+
+    def lines(self):
+        return self.output.splitlines(True)
+
+class CommandError(SystemError):
+
+    def __init__(self, result):
+        if result.timed_out:
+            SystemError.__init__(self, "Timed out", result.command)
+        else:
+            SystemError.__init__(self, result.command)
+        self.result = result
+
+def run(argv, timeout=None, retries=0, check=True, echo=True):
+    """Run a command
+
+    The command and, if echo is true, its output are shown with
+    zc.awsrecipes.say.
+
+    If timeout is given, the command is killed if it takes more than
+    that many seconds.  A command that fails with a transient error,
+    like a busy device, is tried up to retries more times.
+
+    If check is true, a CommandError is raised if the command fails.
+    Otherwise, the Result is returned either way.
+    """
+    result = Result(argv)
+    zc.awsrecipes.say(result.command)
+    start = time.time()
+    while 1:
+        result.attempts += 1
+        attempt(result, timeout, echo)
+        if (result.ok or result.timed_out or result.attempts > retries or
+            not transient(result.output)):
+            break
+        zc.awsrecipes.say('retrying ' + result.command)
+        time.sleep(retry_delay)
+    result.duration = time.time() - start
+    for listener in listeners:
+        listener(result)
+
+    if check and not result.ok:
+        raise CommandError(result)
+    return result
+
+def attempt(result, timeout, echo):
+    proc = subprocess.Popen(result.argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True)
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill, (proc, result))
+        timer.setDaemon(True)
+        timer.start()
+    lines = []
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            lines.append(line)
+            if echo:
+                zc.awsrecipes.say(line.rstrip('\n'))
+        result.status = proc.wait()
+    finally:
+        if timeout is not None:
+            timer.cancel()
+    result.output = ''.join(lines)
+
+def kill(proc, result):
+    result.timed_out = True
+    try:
+        proc.kill()
+    except OSError:
+        pass # It finished after all.
+
+def background(log_path, func, *args):
+    """Call a function in a detached process
+
+    Its output is appended to the file at log_path, a line at a time,
+    so progress can be followed.
+    """
+    if os.fork():
+        return
+    try:
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.dup2(os.open('/dev/null', os.O_RDONLY), 0)
+            sys.stdout = sys.stderr = os.fdopen(1, 'w', 1)
+            func(*args)
+        except:
+            import traceback
+            traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
@@ -0,0 +1,135 @@
+"""Wait for devices to appear
+
+EBS volumes attach at different times, so we wait for all of the
+devices we need at once, waking up when something is added to the
+directories they live in, rather than polling for each in turn.
+
+We use inotify if we can, kernel (udev) uevents if we can't, and fall
+back to polling.
+"""
+import ctypes
+import errno
+import os
+import select
+import socket
+import time
+
+class Inotify:
+    """Wake up when entries are created in the devices' directories
+    """
+
+    IN_ATTRIB = 0x4
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init')
+        try:
+            for d in set(os.path.dirname(path) for path in paths):
+                if libc.inotify_add_watch(
+                    self.fd, d,
+                    self.IN_CREATE | self.IN_MOVED_TO | self.IN_ATTRIB
+                    ) < 0:
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch', d)
+        except:
+            os.close(self.fd)
+            raise
+
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            # We don't care what the events were, as we'll check for
+            # our devices anyway.
+            os.read(self.fd, 65536)
+
+    def close(self):
+        os.close(self.fd)
+
+class Uevents:
+    """Wake up when the kernel announces a block device
+    """
+
+    NETLINK_KOBJECT_UEVENT = 15
+
+    def __init__(self, paths):
+        self.socket = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+        try:
+            self.socket.bind((0, 1))
+        except:
+            self.socket.close()
+            raise
+
+    def wait(self, timeout):
+        if select.select([self.socket], [], [], timeout)[0]:
+            self.socket.recv(65536)
+
+    def close(self):
+        self.socket.close()
+
+class Poll:
+    """Check every so often
+    """
+
+    interval = .25
+
+    def __init__(self, paths):
+        pass
+
+    def wait(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+watchers = Inotify, Uevents, Poll
+
+def watcher(paths):
+    for factory in watchers[:-1]:
+        try:
+            return factory(paths)
+        except (EnvironmentError, AttributeError):
+            pass
+    return watchers[-1](paths)
+
+def wait_for_devices(paths, timeout=None):
+    """Wait for the given device paths to exist
+
+    Return as soon as they all exist, or when timeout seconds have
+    passed.  The set of paths that still don't exist is returned.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    missing = set(paths)
+    w = None
+    try:
+        while 1:
+            missing = set(path for path in missing
+                          if not os.path.exists(path))
+            if not missing:
+                break
+            if w is None:
+                # Check again once we're watching, so we don't miss
+                # devices added while setting up.
+                w = watcher(missing)
+                continue
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            try:
+                w.wait(remaining)
+            except select.error, v:
+                if v.args[0] != errno.EINTR:
+                    raise
+    finally:
+        if w is not None:
+            w.close()
+
+    return missing
@@ -0,0 +1,116 @@
+"""File systems we know how to make, mount and grow
+
+A file system is selected for a volume with an ``fs=`` option in
+/etc/zim/volumes.  The default is ext3.
+"""
+
+class Filesystem:
+    """Base class for file systems
+
+    Subclasses set name, the file system type, and force_option, the
+    mkfs option to make a file system over an existing one, and define
+    grow, which returns the arguments of a command to grow the file
+    system while it's mounted.
+    """
+
+    journaled = False # Takes commit= and data= mount options
+    discards = True # Takes the discard mount option
+    barriers = False # Takes barrier mount options
+
+    def mkfs(self, device, force=False, stripe=None):
+        """Return the arguments of a command to make a file system
+
+        If the device is striped, stripe is a tuple giving the chunk
+        size, in KiB, and the number of data disks, so the file system
+        can be aligned with the stripes.
+        """
+        args = ['mkfs', '-t', self.name]
+        if force:
+            args.append(self.force_option)
+        args.extend(self.mkfs_options(stripe))
+        args.append(device)
+        return args
+
+    def mkfs_options(self, stripe):
+        return []
+
+    def mount(self, device, mount_point, options=()):
+        args = ['mount', '-t', self.name]
+        if options:
+            args.extend(('-o', ','.join(options)))
+        return args + [device, mount_point]
+
+    def fstab(self, device, mount_point, options=()):
+        return '%s %s %s %s 0 1' % (device, mount_point, self.name,
+                                    ','.join(options) or 'defaults')
+
+class Ext3(Filesystem):
+
+    name = 'ext3'
+    force_option = '-F'
+    journaled = True
+    discards = False
+    barriers = True
+    extended_options = ()
+    block_size = 4 # KiB
+
+    def mkfs_options(self, stripe):
+        options = []
+        extended = list(self.extended_options)
+        if stripe:
+            # Strides are in blocks, so make sure we know the block size.
+            options.extend(('-b', str(self.block_size * 1024)))
+            chunk, disks = stripe
+            stride = chunk // self.block_size
+            extended.extend(('stride=%s' % stride,
+                             'stripe-width=%s' % (stride * disks)))
+        if extended:
+            options.extend(('-E', ','.join(extended)))
+        return options
+
+    def barrier(self, on):
+        """Return the mount option that turns write barriers on or off
+        """
+        return 'barrier=%d' % bool(on)
+
+    def grow(self, device, mount_point):
+        return ['resize2fs', device]
+
+class Ext4(Ext3):
+    """ext4, with inode tables and the journal initialized lazily
+
+    Formatting a large volume is quick, and the kernel initializes the
+    inode tables in the background after the first mount.
+    """
+
+    name = 'ext4'
+    extended_options = 'lazy_itable_init=1', 'lazy_journal_init=1'
+    discards = True
+
+class XFS(Filesystem):
+    """xfs, which always uses write barriers
+
+    Linux 4.19 and later refuse to mount xfs with barrier or nobarrier.
+    """
+
+    name = 'xfs'
+    force_option = '-f'
+
+    def mkfs_options(self, stripe):
+        if stripe:
+            return ['-d', 'su=%sk,sw=%s' % stripe]
+        return []
+
+    def grow(self, device, mount_point):
+        return ['xfs_growfs', mount_point]
+
+filesystems = dict((fs.name, fs) for fs in (Ext3(), Ext4(), XFS()))
+default = filesystems['ext3']
+
+def get(name=None):
+    if name is None:
+        return default
+    try:
+        return filesystems[name]
+    except KeyError:
+        raise ValueError("Unknown file system", name)
@@ -0,0 +1,113 @@
+"""Journal the steps of making arrays, so interrupted runs can resume
+
+Making an array for a raid volume takes several steps: creating the
+array, making it a physical volume, adding it to (or creating) the
+volume group, extending (or creating) the logical volume and then
+growing (or making) the file system.  If we die partway through, the
+array exists, but isn't part of the volume, and a later run can't tell
+what to do with it.
+
+So before taking the first step, we record the steps, along with the
+array's devices and number and the volume group, and we record each
+step as it's done.  A later run that finds an unfinished entry for a
+volume checks that the array is the one we were making, and resumes
+with the first step that wasn't done.
+"""
+import json
+import threading
+import zc.awsrecipes
+
+path = '/etc/zim/volumes-journal'
+
+class Journal:
+
+    def __init__(self, entries=None, readonly=False):
+        self.entries = entries or {} # {mount point -> entry}
+        self.readonly = readonly # When planning, nothing is saved
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(class_, readonly=False):
+        try:
+            f = open(path)
+        except IOError:
+            return class_(readonly=readonly)
+        try:
+            try:
+                return class_(json.load(f), readonly)
+            except ValueError:
+                return class_(readonly=readonly)
+        finally:
+            f.close()
+
+    def save(self):
+        if self.readonly:
+            return
+        # Synced to disk before we take the step it records:
+        zc.awsrecipes.save_file(path, json.dumps(
+            self.entries, indent=2, sort_keys=True,
+            separators=(',', ': ')) + '\n')
+
+    def get(self, mount_point):
+        return self.entries.get(mount_point)
+
+    def begin(self, mount_point, steps, **identity):
+        """Record the steps we're about to take for a volume
+
+        identity has the md number, devices, volume group, file system
+        type and data device, so the array can be recognized, and the
+        remaining steps taken, later.
+        """
+        self.lock.acquire()
+        try:
+            entry = dict(identity, steps=list(steps), done=[])
+            self.entries[mount_point] = entry
+            self.save()
+            return entry
+        finally:
+            self.lock.release()
+
+    def done(self, mount_point, step):
+        """Record that a step is done
+
+        When all of a volume's steps are done, its entry is removed.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries[mount_point]
+            entry['done'].append(step)
+            if not [s for s in entry['steps'] if s not in entry['done']]:
+                del self.entries[mount_point]
+            self.save()
+        finally:
+            self.lock.release()
+
+    def drop(self, mount_point):
+        """Remove a volume's entry, if it has one
+        """
+        self.lock.acquire()
+        try:
+            if self.entries.pop(mount_point, None) is not None:
+                self.save()
+        finally:
+            self.lock.release()
+
+    def grows(self):
+        """Return the file systems that are only waiting to be grown
+
+        as file system types, data devices and mount points.
+        """
+        return [(str(entry['fs']), str(entry['data']), str(mount_point))
+                for mount_point, entry in sorted(self.entries.items())
+                if entry['done'] + ['grow'] == entry['steps']]
+
+def grown(mount_point):
+    """Record that a file system was grown
+
+    This is called from the background process that grows file
+    systems, so the journal is loaded fresh.
+    """
+    journal = Journal.load()
+    entry = journal.get(mount_point)
+    if entry is not None and 'grow' in entry['steps']:
+        journal.done(mount_point, 'grow')
@@ -0,0 +1,102 @@
+"""Choose how volumes are mounted
+
+Mount options are chosen with options in /etc/zim/volumes:
+
+profile
+  A named set of the settings below: ``defaults`` (the file system's
+  own defaults), ``throughput`` (noatime and a 30-second journal
+  commit interval) or ``scratch`` (throughput, plus writeback
+  journaling and no write barriers, for data that can be lost, like
+  caches on ephemeral disks).  Settings that don't apply to a volume's
+  file system are left out.
+
+atime
+  ``strictatime``, ``relatime`` or ``noatime`` (with nodiratime).
+
+commit
+  Seconds between journal commits, for ext3 and ext4.
+
+journal
+  Data journaling mode, for ext3 and ext4: ``ordered``, ``writeback``
+  or ``journal``.
+
+barrier
+  ``on`` or ``off``, to turn write barriers on or off, for ext3 and
+  ext4.  xfs always uses them.
+
+discard
+  ``on`` to discard freed blocks as they're freed, for ext4 and xfs,
+  or ``off``.
+
+The options are used when mounting and are saved in /etc/fstab.
+"""
+
+options = 'profile', 'atime', 'commit', 'journal', 'barrier', 'discard'
+
+profiles = {
+    'defaults': {},
+    'throughput': dict(atime='noatime', commit='30'),
+    'scratch': dict(atime='noatime', commit='60', journal='writeback',
+                    barrier='off'),
+    }
+
+choices = dict(
+    atime=('strictatime', 'relatime', 'noatime'),
+    journal=('ordered', 'writeback', 'journal'),
+    barrier=('on', 'off'),
+    discard=('on', 'off'),
+    )
+
+class Mount:
+
+    def __init__(self, profile=None, **settings):
+        if profile is not None and profile not in profiles:
+            raise ValueError("Unknown mount profile", profile)
+        for name, value in settings.items():
+            if name == 'commit':
+                try:
+                    if int(value) < 1:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError("Bad number", name, value)
+            elif value not in choices[name]:
+                raise ValueError("Unsupported mount option", name, value)
+        self.profile = profiles.get(profile, {})
+        self.settings = settings
+
+    def options(self, fs):
+        """Return the mount options for a file system, as a list
+
+        Explicit settings the file system doesn't support are errors.
+        """
+        result = []
+        for name in options[1:]:
+            value = self.settings.get(name)
+            if value is None:
+                value = self.profile.get(name)
+                if value is None or not supports(fs, name, value):
+                    continue
+            elif not supports(fs, name, value):
+                raise ValueError("Unsupported by " + fs.name, name, value)
+            if name == 'atime':
+                result.append(value)
+                if value == 'noatime':
+                    result.append('nodiratime')
+            elif name == 'commit':
+                result.append('commit=%s' % int(value))
+            elif name == 'journal':
+                result.append('data=' + value)
+            elif name == 'barrier':
+                result.append(fs.barrier(value == 'on'))
+            elif value == 'on':
+                result.append('discard')
+        return result
+
+def supports(fs, name, value):
+    if name in ('commit', 'journal'):
+        return fs.journaled
+    if name == 'discard' and value == 'on':
+        return fs.discards
+    if name == 'barrier':
+        return fs.barriers
+    return True
@@ -0,0 +1,291 @@
+"""Plan setting up volumes, and then set them up
+
+Rather than running commands as we decide on them, we make a plan: a
+graph of steps, like creating an array, making a physical volume,
+extending a volume group, making a file system or mounting it, each
+with the steps it has to wait for and an estimate of how long it will
+take.  ``setup-volumes --plan`` shows the plan, and how long it should
+take, without doing anything.
+
+When a plan is carried out, steps whose dependencies are done are
+taken concurrently, up to a limit.  A volume's output is kept
+together, and volumes' output is printed in the order they were
+started, so it reads the same as a serial run.
+"""
+import sys
+import threading
+import zc.awsrecipes
+import zc.awsrecipes.commands
+import zc.awsrecipes.storage
+
+# Rough durations of commands on EBS volumes: seconds, and seconds per
+# GiB of the data they work on.  Commands not listed take no time to
+# speak of.
+estimates = {
+    'mdadm --create': (1, 0),
+    'mdadm --assemble': (1, 0),
+    'mdadm --grow': (1, 0),
+    'pvcreate': (.2, 0),
+    'vgcreate': (.3, 0),
+    'vgextend': (.2, 0),
+    'vgchange': (.5, 0),
+    'vgreduce': (.5, 0),
+    'lvcreate': (.5, 0),
+    'lvextend': (.3, 0),
+    'mkfs -t ext3': (2, 2),
+    'mkfs -t ext4': (2, .02),
+    'mkfs -t xfs': (1, .01),
+    'resize2fs': (1, 1),
+    'xfs_growfs': (1, 0),
+    'mount': (.1, 0),
+    }
+
+def estimate(argv, size=None):
+    """Estimate how long a command will take, in seconds
+
+    size is the number of bytes it works on, if we know.
+    """
+    for n in 3, 2, 1:
+        found = estimates.get(' '.join(argv[:n]))
+        if found is not None:
+            seconds, per_gib = found
+            return seconds + per_gib * (size or 0) / float(1 << 30)
+    return 0
+
+def size(names):
+    """Return the total size of the named devices, in bytes
+
+    Devices that aren't there (yet) count as empty.
+    """
+    total = 0
+    for name in names:
+        try:
+            total += zc.awsrecipes.storage.device_size(name)
+        except EnvironmentError:
+            pass
+    return total
+
+class Step:
+
+    def __init__(self, number, name, func, args, volume, after, estimate,
+                 background):
+        self.number = number
+        self.name = name
+        self.func = func
+        self.args = args
+        self.volume = volume
+        self.after = after
+        self.estimate = estimate
+        self.background = background
+        self.state = None # running, done, failed or skipped
+
+class Plan:
+
+    def __init__(self):
+        self.steps = []
+        self.last = {} # {volume -> the step added for it last}
+
+    def add(self, name, func, args=(), volume=None, after=None, estimate=0,
+            background=False):
+        """Add a step, and return it
+
+        name says what the step does, usually as the command it runs.
+        func is called with args to take it.
+
+        volume is the mount point of the volume the step is for.  The
+        step comes after the steps in after, or, by default, after the
+        step added for the volume before it.
+
+        The step is estimated to take estimate seconds.  If background
+        is true, the work it stands for is done in the background,
+        after setting up, like growing file systems.
+        """
+        if after is None:
+            after = [self.last[volume]] if volume in self.last else []
+        step = Step(len(self.steps) + 1, name, func, args, volume,
+                    list(after), estimate, background)
+        self.steps.append(step)
+        self.last[volume] = step
+        return step
+
+    def command(self, argv, volume=None, after=None, size=None, then=None,
+                **kw):
+        """Add a step that runs a command, and return it
+
+        The step is named by the command, and its duration estimated
+        from the size, in bytes, of the data it works on.  If then is
+        given, it's called after the command succeeds.  Other keyword
+        arguments are passed to zc.awsrecipes.s.
+        """
+        argv = list(argv)
+        def run():
+            zc.awsrecipes.s(*argv, **kw)
+            if then is not None:
+                then()
+        return self.add(zc.awsrecipes.commands.format(argv), run,
+                        volume=volume, after=after,
+                        estimate=estimate(argv, size))
+
+    def duration(self, jobs=1):
+        """Estimate how long taking the steps will take
+
+        Steps are started in the order they were added, when the steps
+        they come after are done, with up to jobs running at once.
+        Background work isn't included.
+        """
+        pending = [step for step in self.steps if not step.background]
+        done = set()
+        running = [] # [(finish time, step number, step)]
+        now = 0
+        while pending or running:
+            for step in list(pending):
+                if len(running) >= jobs:
+                    break
+                if not [s for s in step.after
+                        if s not in done and not s.background]:
+                    pending.remove(step)
+                    running.append((now + step.estimate, step.number, step))
+            running.sort()
+            now, number, step = running.pop(0)
+            done.add(step)
+        return now
+
+    def show(self, jobs=1):
+        """Show the steps and how long we expect them to take
+        """
+        say = zc.awsrecipes.say
+        say('%4s %8s %8s  %s' % ('step', 'after', 'seconds', 'command'))
+        for step in self.steps:
+            name = step.name
+            if step.background:
+                name += ' (in the background)'
+            say('%4s %8s %8.1f  %s' % (
+                step.number, ','.join(str(s.number) for s in step.after),
+                step.estimate, name))
+        say('estimated %.1f seconds with %s job%s' % (
+            self.duration(jobs), jobs, jobs != 1 and 's' or ''))
+        background = sum(step.estimate for step in self.steps
+                         if step.background)
+        if background:
+            say('then %.1f seconds in the background' % background)
+
+    def run(self, jobs=1, report=None):
+        """Take the steps, up to jobs at a time
+
+        Steps are started in the order they were added, when the steps
+        they come after are done.  With one job, a failed step's error
+        is raised right away.  Otherwise, steps that don't depend on
+        failed steps are taken, and then the first error is raised.
+
+        If report is given, it records how long each volume took.
+        """
+        self.report = report
+        self.timers = {} # {volume -> function to call when it's done}
+        self.remaining = {} # {volume -> number of steps not finished}
+        for step in self.steps:
+            self.remaining[step.volume] = (
+                self.remaining.get(step.volume, 0) + 1)
+        if jobs <= 1 or len(self.steps) <= 1:
+            for step in self.steps:
+                self.start(step)
+                try:
+                    step.func(*step.args)
+                except:
+                    self.finish(step, 'failed')
+                    if step.volume in self.timers:
+                        self.timers.pop(step.volume)()
+                    raise
+                self.finish(step, 'done')
+            return
+
+        self.condition = threading.Condition()
+        self.blocks = {} # {volume -> output block}
+        self.errors = []
+        threads = [threading.Thread(target=self.work)
+                   for i in range(min(jobs, len(self.steps)))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0][0], self.errors[0][1], self.errors[0][2]
+
+    def start(self, step):
+        step.state = 'running'
+        if self.report is not None and step.volume not in self.timers:
+            self.timers[step.volume] = self.report.volume(step.volume)
+
+    def finish(self, step, state):
+        step.state = state
+        self.remaining[step.volume] -= 1
+        if not self.remaining[step.volume]:
+            if step.volume in self.timers:
+                self.timers.pop(step.volume)()
+            return True
+        return False
+
+    def next(self):
+        """Return the next step ready to be taken
+
+        Steps that depend on failed steps are skipped.  If there are
+        no more steps to take, return None.
+        """
+        while 1:
+            waiting = False
+            for step in self.steps:
+                if step.state is not None:
+                    continue
+                states = set(s.state for s in step.after)
+                if states & set(('failed', 'skipped')):
+                    if self.finish(step, 'skipped'):
+                        self.done(step.volume)
+                    break # Look again, for steps that depended on it
+                if states - set(('done', )):
+                    waiting = True
+                    continue
+                self.start(step)
+                if step.volume not in self.blocks:
+                    self.blocks[step.volume] = zc.awsrecipes.output.start()
+                return step
+            else:
+                if not (waiting or [s for s in self.steps
+                                    if s.state == 'running']):
+                    return None
+                self.condition.wait()
+
+    def done(self, volume):
+        block = self.blocks.pop(volume, None)
+        if block is not None:
+            zc.awsrecipes.output.done(block)
+
+    def work(self):
+        output = zc.awsrecipes.output
+        while 1:
+            self.condition.acquire()
+            try:
+                step = self.next()
+                if step is None:
+                    self.condition.notifyAll()
+                    return
+                block = self.blocks[step.volume]
+            finally:
+                self.condition.release()
+            output.local.block = block
+            state = 'done'
+            try:
+                try:
+                    step.func(*step.args)
+                except Exception, v:
+                    zc.awsrecipes.say('%s: %s' % (v.__class__.__name__, v))
+                    self.errors.append(sys.exc_info())
+                    state = 'failed'
+            finally:
+                output.local.block = None
+                self.condition.acquire()
+                try:
+                    if self.finish(step, state):
+                        self.done(step.volume)
+                    self.condition.notifyAll()
+                finally:
+                    self.condition.release()
@@ -0,0 +1,213 @@
+"""Read every block of volumes restored from snapshots
+
+EBS volumes restored from snapshots fetch each block from S3 the first
+time it's read, so first reads are very slow.  Reading every block
+ahead of time gets that over with before a volume sees real traffic.
+
+Devices are read in large chunks, with direct I/O so the page cache
+isn't flooded, by a bounded number of threads and, optionally, at a
+limited rate.  Progress is saved as we go, so warming that's
+interrupted, by a reboot say, resumes where it left off.
+"""
+import errno
+import io
+import mmap
+import optparse
+import os
+import Queue
+import sys
+import threading
+import time
+import zc.awsrecipes
+import zc.awsrecipes.commands
+
+chunk_size = 1 << 20 # bytes per read
+save_every = 256 # chunks between saves of progress
+report_interval = 10 # seconds between progress reports
+
+progress_dir = '/var/lib/zim/prewarm'
+log_path = '/var/log/zim-prewarm.log'
+
+class RateLimit:
+    """Limit the rate, in bytes per second, shared by several threads
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def take(self, n):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + float(n) / self.rate
+        finally:
+            self.lock.release()
+        if start > now:
+            time.sleep(start - now)
+
+class Warmer:
+
+    def __init__(self, devices, jobs=4, rate=None, out=None):
+        self.devices = list(devices)
+        self.jobs = jobs
+        if rate:
+            self.limit = RateLimit(rate).take
+        else:
+            self.limit = None
+        self.out = out or sys.stdout
+        self.lock = threading.Lock()
+
+    def say(self, message):
+        self.lock.acquire()
+        try:
+            print >>self.out, message
+            self.out.flush()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """Warm the devices, up to jobs at a time
+        """
+        if not os.path.exists(progress_dir):
+            os.makedirs(progress_dir)
+        queue = Queue.Queue()
+        for device in self.devices:
+            queue.put(device)
+        errors = []
+        def work():
+            while 1:
+                try:
+                    device = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.warm(device)
+                except EnvironmentError, v:
+                    self.say('%s: %s' % (device, v))
+                    errors.append(device)
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.jobs, len(self.devices)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return not errors
+
+    def load_progress(self, device, size):
+        progress = read_progress(device)
+        if progress is None or progress[1] != size:
+            return 0 # Not the device we were warming
+        return progress[0]
+
+    def save_progress(self, device, offset, size):
+        zc.awsrecipes.save_file(progress_path(device),
+                                '%s %s\n' % (offset, size))
+
+    def warm(self, device):
+        f = open_direct(device)
+        try:
+            size = int(f.seek(0, 2))
+            offset = self.load_progress(device, size)
+            if offset >= size:
+                self.say('%s already warm' % device)
+                return
+            if offset:
+                self.say('%s resuming at %s%%'
+                         % (device, percent(offset, size)))
+            else:
+                self.save_progress(device, offset, size)
+            start = reported = time.time()
+            buf = mmap.mmap(-1, chunk_size) # aligned, for direct I/O
+            chunks = 0
+            f.seek(offset)
+            while offset < size:
+                if self.limit is not None:
+                    self.limit(chunk_size)
+                n = f.readinto(buf)
+                if not n:
+                    break
+                offset += n
+                chunks += 1
+                if chunks % save_every == 0:
+                    self.save_progress(device, offset, size)
+                if time.time() - reported >= report_interval:
+                    reported = time.time()
+                    self.say('%s %s%%' % (device, percent(offset, size)))
+            self.save_progress(device, size, size)
+            self.say('%s warmed %s MiB in %.1f seconds' % (
+                device, size >> 20, time.time() - start))
+        finally:
+            f.close()
+
+def progress_path(device):
+    return os.path.join(progress_dir, device.strip('/').replace('/', '-'))
+
+def read_progress(device):
+    """Return the bytes read and size of a device, or None
+    """
+    try:
+        f = open(progress_path(device))
+    except IOError:
+        return None
+    try:
+        try:
+            offset, size = map(int, f.read().split())
+        except ValueError:
+            return None
+    finally:
+        f.close()
+    return offset, size
+
+def unfinished(devices):
+    """Return the devices we started warming and didn't finish
+    """
+    result = []
+    for device in devices:
+        progress = read_progress(device)
+        if progress is not None and progress[0] < progress[1]:
+            result.append(device)
+    return result
+
+def percent(offset, size):
+    return offset * 100 // size
+
+def open_direct(path):
+    flags = os.O_RDONLY
+    try:
+        fd = os.open(path, flags | getattr(os, 'O_DIRECT', 0))
+    except OSError, v:
+        if v.errno != errno.EINVAL:
+            raise
+        # Not supported by the file system. Read through the cache.
+        fd = os.open(path, flags)
+    return io.FileIO(fd)
+
+def run(devices, jobs=4, rate=None):
+    return Warmer(devices, jobs, rate).run()
+
+def start(devices, jobs=4, rate=None):
+    """Warm devices in the background
+    """
+    zc.awsrecipes.commands.background(log_path, run, devices, jobs, rate)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage='%prog [options] device ...')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+                      help='Devices to read at once (default 4)')
+    parser.add_option('-r', '--rate', type='float', metavar='MB/SEC',
+                      help='Limit on the total read rate')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('no devices given')
+
+    if not run(args, options.jobs, options.rate and options.rate * (1 << 20)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
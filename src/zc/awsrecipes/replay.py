@@ -0,0 +1,89 @@
+"""Record what storage probes output, and replay it
+
+A storage snapshot is built from /proc/mdstat, the sizes in
+/sys/block, an LVM report and what ``mdadm --examine`` finds.
+``setup-volumes --record PATH`` saves what they output on a host in a
+JSON bundle, without setting anything up.
+
+Replaying a bundle builds a snapshot from it with the same parsing
+code, so the parsing can be tested, and timed, with what real hosts
+output, rather than what the simulated machine in the tests outputs.
+Bundles recorded on hosts with unusual layouts are kept in the
+``recorded`` directory.
+"""
+import json
+import os
+import zc.awsrecipes
+import zc.awsrecipes.storage
+
+corpus = os.path.join(os.path.dirname(__file__), 'recorded')
+
+def examinable(name):
+    """Can the named block device hold md superblocks we'd care about?
+    """
+    return not (name.startswith('md') or name.startswith('dm-') or
+                name.startswith('loop') or name.startswith('ram'))
+
+def record(examine=None):
+    """Return what the storage probes output, as a bundle
+
+    examine names the devices to examine for md superblocks.  By
+    default, array members and the block devices that aren't arrays,
+    device-mapper volumes, loop devices or RAM disks are examined.
+    """
+    storage = zc.awsrecipes.storage
+    f = open('/proc/mdstat')
+    mdstat = f.read()
+    f.close()
+    sizes = storage.sys_block_sizes()
+    if examine is None:
+        snapshot = storage.StorageSnapshot()
+        snapshot.read_mdstat(mdstat.splitlines(True))
+        examine = set(snapshot.members)
+        examine.update(name for name in sizes if examinable(name))
+    return dict(
+        mdstat=mdstat,
+        sizes=sizes,
+        lvm=''.join(storage.lvm_report()),
+        examined=sorted(examine),
+        examine=examine and ''.join(storage.examine_output(examine)) or '',
+        )
+
+def save(bundle, path):
+    zc.awsrecipes.save_file(path, json.dumps(
+        bundle, indent=1, sort_keys=True, separators=(',', ': ')) + '\n')
+
+def load(path):
+    f = open(path)
+    bundle = json.load(f)
+    f.close()
+    return encode(bundle)
+
+def encode(data):
+    # JSON strings load as unicode, but probes output bytes.
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, dict):
+        return dict((encode(k), encode(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return [encode(v) for v in data]
+    return data
+
+def replay(bundle):
+    """Build a storage snapshot from a bundle
+
+    Return the snapshot and the arrays found by examining devices, as
+    StorageSnapshot.scan does.
+    """
+    snapshot = zc.awsrecipes.storage.StorageSnapshot()
+    snapshot.read_mdstat(bundle['mdstat'].splitlines(True))
+    snapshot.read_sizes(bundle['sizes'])
+    snapshot.read_lvm_report(bundle['lvm'].splitlines(True))
+    arrays = snapshot.read_examine(bundle['examine'].splitlines(True))
+    return snapshot, arrays
+
+def recorded():
+    """Return the paths of the bundles in the corpus
+    """
+    return [os.path.join(corpus, name) for name in sorted(os.listdir(corpus))
+            if name.endswith('.json')]
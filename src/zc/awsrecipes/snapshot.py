@@ -0,0 +1,122 @@
+"""Take crash-consistent snapshots of the volumes we set up
+
+A raid volume's file system is spread over all of its devices, so
+snapshots of the devices are only consistent with each other if they're
+all started while the file system is frozen.  Writes stall while it's
+frozen, so we keep the freeze short: dirty data are synced before
+freezing, and snapshots of all of the devices are started at once.
+The file system is thawed as soon as they've all been started.
+
+Starting a snapshot is up to a hook, a function named like
+``module:function`` that's called with a device path and the mount
+point of its volume, and may return something to report, like a
+snapshot id.
+"""
+import optparse
+import sys
+import time
+import zc.awsrecipes
+import zc.awsrecipes.storage
+import zc.awsrecipes.watch
+
+def volumes(lines, mount_points=None):
+    """Return the volumes set up from configuration lines
+
+    For each volume, its mount point, the devices to snapshot and the
+    block devices to flush once it's frozen are returned.  If mount
+    points are given, only their volumes are returned.
+    """
+    storage = None
+    result = []
+    for line in lines:
+        mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+        if sdvols[0][0] == '/':
+            continue # A link
+        if mount_points and mount_point not in mount_points:
+            continue
+        if len(sdvols) == 1:
+            devices = ['/dev/' + sdvols[0]]
+            flush = devices
+        elif zc.awsrecipes.lvname(sdvols[0]):
+            devices = ['/dev/' + name for name in sdvols[1:]]
+            flush = ['/dev/' + sdvols[0]] + devices
+        else:
+            if options.get('cache') and (
+                options.get('cache_mode') == 'writeback'):
+                raise ValueError("Volumes with writeback caches can't be"
+                                 " snapshotted consistently", mount_point)
+            if storage is None:
+                storage = zc.awsrecipes.storage.StorageSnapshot()
+                storage.read_mdstat(open('/proc/mdstat'))
+            devices = ['/dev/' + name for name in sdvols]
+            mds = sorted(set(storage.arrays[storage.members[name]].path
+                             for name in sdvols if name in storage.members))
+            flush = ['/dev/vg_%s/data' % sdvols[0][:3]] + mds
+        result.append((mount_point, devices, flush))
+    return result
+
+def freeze(mount_point, devices, flush, hook):
+    """Start snapshots of devices with the file system on them frozen
+
+    Return the number of seconds it was frozen.
+    """
+    zc.awsrecipes.s('sync')
+    zc.awsrecipes.s('fsfreeze', '--freeze', mount_point)
+    start = time.time()
+    try:
+        for path in flush:
+            zc.awsrecipes.s('blockdev', '--flushbufs', path)
+        if len(devices) > 1:
+            pool = zc.awsrecipes.Pool(len(devices))
+        else:
+            pool = zc.awsrecipes.Serial()
+        for device in devices:
+            pool.submit(take, hook, device, mount_point)
+        pool.join()
+    finally:
+        zc.awsrecipes.s('fsfreeze', '--unfreeze', mount_point)
+        frozen = time.time() - start
+        zc.awsrecipes.say('%s was frozen for %.3f seconds'
+                          % (mount_point, frozen))
+    return frozen
+
+def take(hook, device, mount_point):
+    result = hook(device, mount_point)
+    if result is not None:
+        zc.awsrecipes.say('snapshot of %s: %s' % (device, result))
+
+def load_hook(name):
+    module, attr = name.split(':')
+    return getattr(__import__(module, {}, {}, ['*']), attr)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage='%prog [options] [mount-point ...]')
+    parser.add_option(
+        '--hook', metavar='MODULE:FUNCTION',
+        help='Function called to start a snapshot of a device')
+    options, args = parser.parse_args(args)
+    if not options.hook or ':' not in options.hook:
+        parser.error('a hook, like module:function, is required')
+    hook = load_hook(options.hook)
+
+    lines = zc.awsrecipes.read_config(zc.awsrecipes.watch.config_path)
+    unknown = set(args) - set(line.split()[0] for line in lines)
+    if unknown:
+        parser.error('not set up: %s' % ' '.join(sorted(unknown)))
+
+    ok = True
+    for mount_point, devices, flush in volumes(lines, args):
+        try:
+            freeze(mount_point, devices, flush, hook)
+        except Exception, v:
+            zc.awsrecipes.say("couldn't snapshot %s: %s: %s" % (
+                mount_point, v.__class__.__name__, v))
+            ok = False
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""Report on the volumes we set up, and how busy their devices are
+
+``setup-volumes --status`` shows each volume set up, with the volume
+group, arrays and devices under it, as found in /proc/mdstat,
+/sys/block and LVM, their write-intent bitmaps, and the progress of
+arrays being resynced or recovered.
+
+It also samples /proc/diskstats over an interval, and reports each
+device's IOPS, throughput, average wait, queue depth and utilization.
+The members of a raid array should be about equally busy.  If one is
+much busier than the average, it's probably slow, and it holds the
+whole array back, so each array's busiest member is reported, with
+how much busier it is than the average.
+
+The report is shown as text, or as JSON, or in the Prometheus text
+format, for the node exporter's textfile collector.
+"""
+import json
+import os
+import time
+import zc.awsrecipes
+import zc.awsrecipes.storage
+import zc.awsrecipes.timing
+import zc.awsrecipes.watch
+
+formats = 'text', 'json', 'prometheus'
+
+def layout(lines, storage, in_use):
+    """Return the volumes set up, with the devices under them
+
+    lines are configuration lines, storage is a storage snapshot and
+    in_use is the set of mount points in use.  Each volume is a
+    dictionary with its mount point, whether it's mounted, its volume
+    group, if it has one, the name of the block device its file system
+    is on, and the arrays and other devices under that.  An array's
+    write-intent bitmap, if it has one, is internal or kept in an
+    external file, and has a chunk size in KiB.
+    """
+    volumes = []
+    for line in lines:
+        mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+        if sdvols[0][0] == '/':
+            continue # A link
+        volume = dict(mount_point=mount_point,
+                      mounted=mount_point in in_use,
+                      vg=None, device=None, arrays=[], devices=[])
+        volumes.append(volume)
+        if len(sdvols) == 1:
+            volume['device'] = sdvols[0]
+            continue
+
+        if zc.awsrecipes.lvname(sdvols[0]):
+            lv = sdvols[0]
+        else:
+            lv = 'vg_%s/data' % sdvols[0][:3]
+        vg = volume['vg'] = lv.split('/')[0]
+        if vg not in storage.vgs:
+            continue # Not there, or not set up yet
+        path = '/dev/' + lv
+        real = os.path.realpath(path)
+        if real != path:
+            volume['device'] = os.path.basename(real)
+        for pv in sorted(storage.vgs[vg]):
+            name = os.path.basename(pv)
+            array = storage.arrays.get(name[2:])
+            if name.startswith('md') and array is not None:
+                sync = None
+                if array.sync:
+                    sync = dict(zip(
+                        ('action', 'percent', 'minutes_left', 'speed'),
+                        array.sync))
+                bitmap = None
+                if array.bitmap:
+                    bitmap = dict(
+                        location=array.bitmap_file and 'external' or
+                        'internal',
+                        file=array.bitmap_file, chunk_kib=array.bitmap)
+                volume['arrays'].append(dict(
+                    name=name, level=array.level, status=array.status,
+                    members=sorted(array.members),
+                    failed=sorted(array.failed),
+                    spares=sorted(array.spares), sync=sync,
+                    bitmap=bitmap))
+            else:
+                volume['devices'].append(name)
+    return volumes
+
+def names(volume):
+    """Return the names of a volume's block devices, from the top down
+    """
+    result = []
+    if volume['device']:
+        result.append(volume['device'])
+    for array in volume['arrays']:
+        result.append(array['name'])
+        result.extend(array['members'])
+    return result + [name for name in volume['devices']
+                     if name not in result]
+
+# The fields of /proc/diskstats after the device name:
+fields = ('reads', 'reads_merged', 'sectors_read', 'ms_reading',
+          'writes', 'writes_merged', 'sectors_written', 'ms_writing',
+          'in_flight', 'ms_io', 'weighted_ms_io')
+
+def read_diskstats():
+    f = open('/proc/diskstats')
+    stats = {}
+    for line in f:
+        words = line.split()
+        if len(words) >= len(fields) + 3:
+            stats[words[2]] = dict(
+                zip(fields, [int(word) for word in words[3:]]))
+    f.close()
+    return stats
+
+def rates(before, after, seconds):
+    """Return what a device did between two samples of its counters
+    """
+    d = dict((name, after[name] - before[name]) for name in fields)
+    ios = d['reads'] + d['writes']
+    return dict(
+        reads_per_second=round(d['reads'] / seconds, 3),
+        writes_per_second=round(d['writes'] / seconds, 3),
+        read_bytes_per_second=int(d['sectors_read'] * 512 / seconds),
+        write_bytes_per_second=int(d['sectors_written'] * 512 / seconds),
+        await_ms=round(ios and (d['ms_reading'] + d['ms_writing'])
+                       / float(ios), 3),
+        queue_depth=round(d['weighted_ms_io'] / (seconds * 1000), 3),
+        utilization=round(min(d['ms_io'] / (seconds * 1000), 1.0), 3),
+        in_flight=after['in_flight'],
+        )
+
+def measure(volumes, interval):
+    """Return the activity of the volumes' devices over interval seconds
+
+    The result is a dictionary of rates by device name.  The busiest
+    member of each array and its utilization relative to the members'
+    average (its imbalance) are added to the array.
+    """
+    interval = float(interval)
+    before = read_diskstats()
+    time.sleep(interval)
+    after = read_diskstats()
+    stats = {}
+    for volume in volumes:
+        for name in names(volume):
+            if name in before and name in after:
+                stats[name] = rates(before[name], after[name], interval)
+        for array in volume['arrays']:
+            busy = sorted((stats[name]['utilization'], name)
+                          for name in array['members'] if name in stats)
+            mean = busy and sum(u for u, name in busy) / len(busy)
+            if mean:
+                array['busiest'] = busy[-1][1]
+                array['imbalance'] = round(busy[-1][0] / mean, 2)
+    return stats
+
+def text(volumes, stats):
+    lines = []
+    for volume in volumes:
+        where = volume['vg'] or volume['device']
+        if volume['vg'] and volume['device']:
+            where += ' (%s)' % volume['device']
+        lines.append('%s: %s, %s' % (
+            volume['mount_point'], where,
+            volume['mounted'] and 'mounted' or 'not mounted'))
+        for array in volume['arrays']:
+            members = []
+            for name in array['members']:
+                if name in array['failed']:
+                    name += '(F)'
+                elif name in array['spares']:
+                    name += '(S)'
+                members.append(name)
+            bitmap = array['bitmap']
+            if bitmap:
+                bitmap = '%(location)s bitmap %(chunk_kib)sK' % bitmap
+            lines.append('  %s: %s, %s, %s' % (
+                array['name'],
+                ' '.join(filter(None, (array['status'], array['level']))),
+                bitmap or 'no bitmap', ' '.join(members)))
+            if array['bitmap'] and array['bitmap']['file']:
+                lines.append('    bitmap file: ' + array['bitmap']['file'])
+            sync = array['sync']
+            if sync:
+                lines.append(
+                    '    %(action)s %(percent).1f%% done,'
+                    ' %(minutes_left).1f minutes left at %(speed)sK/sec'
+                    % sync)
+            if array.get('busiest'):
+                lines.append(
+                    '    %s is busiest, %.2f times the average member'
+                    % (array['busiest'], array['imbalance']))
+        if volume['devices'] and volume['vg']:
+            lines.append('  devices: ' + ' '.join(volume['devices']))
+        measured = [name for name in names(volume) if name in stats]
+        if measured:
+            lines.append('  %-8s %8s %8s %7s %7s %7s %6s %5s' % (
+                'device', 'r/s', 'w/s', 'rMB/s', 'wMB/s', 'await',
+                'queue', 'util'))
+            for name in measured:
+                r = stats[name]
+                lines.append(
+                    '  %-8s %8.1f %8.1f %7.2f %7.2f %7.1f %6.2f %4.0f%%' % (
+                        name, r['reads_per_second'], r['writes_per_second'],
+                        r['read_bytes_per_second'] / float(1 << 20),
+                        r['write_bytes_per_second'] / float(1 << 20),
+                        r['await_ms'], r['queue_depth'],
+                        r['utilization'] * 100))
+    return lines
+
+def prometheus(volumes, stats):
+    metric = zc.awsrecipes.timing.metric
+    lines = []
+    metric(lines, 'zim_volume_mounted', 'Whether the volume is mounted.',
+           [((('mount_point', v['mount_point']), ), int(v['mounted']))
+            for v in volumes])
+    arrays = [a for v in volumes for a in v['arrays']]
+    metric(lines, 'zim_volume_array_members',
+           'Number of members of a raid array.',
+           [((('array', a['name']), ), len(a['members'])) for a in arrays])
+    metric(lines, 'zim_volume_array_failed_members',
+           'Failed members of a raid array.',
+           [((('array', a['name']), ), len(a['failed'])) for a in arrays])
+    metric(lines, 'zim_volume_array_bitmap_chunk_bytes',
+           "Write-intent bitmap chunk size, or 0.",
+           [((('array', a['name']),
+              ('bitmap', a['bitmap'] and a['bitmap']['location'] or 'none')),
+             a['bitmap'] and a['bitmap']['chunk_kib'] * 1024 or 0)
+            for a in arrays])
+    metric(lines, 'zim_volume_array_sync_ratio',
+           'Fraction of a resync or recovery done.',
+           [((('array', a['name']), ('action', a['sync']['action'])),
+             a['sync']['percent'] / 100)
+            for a in arrays if a['sync']])
+    metric(lines, 'zim_volume_array_imbalance',
+           "Busiest member's utilization / mean.",
+           [((('array', a['name']), ('member', a['busiest'])),
+             a['imbalance'])
+            for a in arrays if a.get('busiest')])
+    devices = [((('mount_point', v['mount_point']), ('device', name)),
+                stats[name])
+               for v in volumes for name in names(v) if name in stats]
+    for name, help in (
+        ('reads_per_second', 'Reads completed per second.'),
+        ('writes_per_second', 'Writes completed per second.'),
+        ('read_bytes_per_second', 'Bytes read per second.'),
+        ('write_bytes_per_second', 'Bytes written per second.'),
+        ('await_ms', 'Average time to complete a request.'),
+        ('queue_depth', 'Average number of requests in progress.'),
+        ('utilization', 'Fraction of time the device was busy.'),
+        ):
+        if name == 'await_ms':
+            metric(lines, 'zim_volume_await_seconds', help,
+                   [(labels, round(r[name] / 1000, 6))
+                    for labels, r in devices])
+        else:
+            metric(lines, 'zim_volume_' + name, help,
+                   [(labels, r[name]) for labels, r in devices])
+    return lines
+
+def report(interval=1, format='text', textfile=None):
+    """Report on the volumes set up
+
+    If interval is positive, device activity is measured over that
+    many seconds.  If a textfile is given, the report is saved there,
+    rather than printed.
+    """
+    lines = zc.awsrecipes.read_config(zc.awsrecipes.watch.config_path)
+    storage = zc.awsrecipes.storage.StorageSnapshot()
+    with zc.awsrecipes.output.quiet():
+        storage.read_kernel()
+        storage.read_lvm()
+    volumes = layout(lines, storage, zc.awsrecipes.mounted())
+    stats = {}
+    if interval > 0:
+        stats = measure(volumes, interval)
+
+    if format == 'json':
+        lines = json.dumps(dict(volumes=volumes, devices=stats),
+                           indent=2, sort_keys=True,
+                           separators=(',', ': ')).split('\n')
+    elif format == 'prometheus':
+        lines = prometheus(volumes, stats)
+    else:
+        lines = text(volumes, stats)
+
+    if textfile:
+        zc.awsrecipes.save_file(textfile,
+                                ''.join(line + '\n' for line in lines))
+    else:
+        for line in lines:
+            print line
@@ -0,0 +1,278 @@
+"""What we know about the machine's storage
+
+Rather than running scanning tools over and over, we build a snapshot
+once, from /proc/mdstat, /sys/block and a single LVM report, and keep
+it up to date as we make changes.  The probes are independent, so the
+slow ones (the LVM report and examining devices for md superblocks)
+run at the same time.
+"""
+import json
+import os
+import re
+import threading
+import zc.awsrecipes
+import zc.awsrecipes.commands
+
+# Scans can hang on failing devices, so don't wait forever.  Each
+# probe has its own limit, in seconds:
+examine_timeout = 300
+lvm_timeout = 300
+
+# An array's line: its number, its state, maybe a read-only note, its
+# level (which inactive arrays don't show) and its members:
+mdstat_line = re.compile(
+    r'md(\w+) : (\w+)(?: \([\w-]+\))?'
+    r'(?: (raid\d+|linear|multipath|faulty))? (.+)$').match
+# A member, with flags for failed (F), spare (S), write-mostly (W) and
+# replacement (R) devices:
+mdstat_member = re.compile(r'(\w+)\[\d+\]((?:\([A-Z]\))*)$').match
+# A bitmap's line, with the file an external bitmap is kept in:
+mdstat_bitmap = re.compile(
+    r'\s+bitmap: .*, (\d+)KB chunk(?:, file: (\S+))?').match
+mdstat_progress = re.compile(
+    r'\s+\[[=>.]*\]\s+(\w+)\s*=\s*([\d.]+)%.*'
+    r'finish=([\d.]+)min\s+speed=(\d+)K/sec').match
+
+def array_field(line, name):
+    """Return the value of a name=value field of an ARRAY line, or None
+    """
+    for word in line.split():
+        if word.startswith(name + '='):
+            return word[len(name) + 1:]
+
+def device_size(name):
+    """Return the size of a block device (or partition), in bytes
+    """
+    return int(open('/sys/class/block/%s/size' % name).read()) * 512
+
+def examine_output(devices):
+    """Return the lines mdadm --examine --brief --verbose outputs
+    """
+    result = zc.awsrecipes.s(
+        'mdadm', '--examine', '--brief', '--verbose',
+        *['/dev/' + name for name in sorted(devices)],
+        timeout=examine_timeout, check=False, echo=False)
+    if result.timed_out:
+        # Devices without superblocks make mdadm fail, but not this.
+        raise zc.awsrecipes.commands.CommandError(result)
+    return result.lines()
+
+def lvm_report():
+    """Return the lines of an LVM report on physical volumes
+    """
+    return zc.awsrecipes.p(
+        'pvs', '--reportformat', 'json', '-o', 'pv_name,vg_name',
+        timeout=lvm_timeout)
+
+def sys_block_sizes():
+    """Return the contents of the size files of the devices in /sys/block
+    """
+    sizes = {}
+    for name in os.listdir('/sys/block'):
+        sizes[name] = open('/sys/block/%s/size' % name).read()
+    return sizes
+
+class Array:
+
+    def __init__(self, mdnum, status, level, members, failed=(), spares=(),
+                 bitmap=None):
+        self.mdnum = mdnum
+        self.status = status
+        self.level = level # None for inactive arrays
+        self.members = list(members)
+        self.failed = set(failed)
+        self.spares = set(spares)
+        self.bitmap = bitmap # write-intent bitmap chunk size in KiB
+        self.bitmap_file = None # where an external bitmap is kept
+        # (action, percent done, minutes left, KiB/second) while the
+        # array is resyncing, recovering or reshaping:
+        self.sync = None
+
+    @property
+    def path(self):
+        return '/dev/md%s' % self.mdnum
+
+class StorageSnapshot:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrays = {}   # {mdnum -> Array}
+        self.members = {}  # {member device name -> mdnum}
+        self.devices = {}  # {block device name -> size in bytes}
+        self.pvs = {}      # {physical volume path -> vg name or None}
+        self.vgs = {}      # {vg name -> set of physical volume paths}
+        self.superblocks = set() # {device name with an md superblock}
+        self.reserved = set()
+
+    @classmethod
+    def load(class_, lvm=True):
+        self = class_()
+        self.scan(lvm)
+        return self
+
+    def scan(self, lvm=True, examine=()):
+        """Read what's there, running the probes concurrently
+
+        /proc/mdstat and /sys/block are read while the LVM report is
+        made, if lvm is true, and the devices named in examine are
+        examined for md superblocks.  The arrays found by examining
+        devices are returned.  If a probe fails, its error is raised
+        after the others finish.
+        """
+        arrays = []
+        probes = [self.read_kernel]
+        if examine:
+            probes.append(lambda: arrays.extend(self.examine(examine)))
+        if lvm:
+            probes.append(self.read_lvm)
+        if len(probes) > 1:
+            pool = zc.awsrecipes.Pool(len(probes))
+        else:
+            pool = zc.awsrecipes.Serial()
+        for probe in probes:
+            pool.submit(probe)
+        pool.join()
+        return arrays
+
+    def read_kernel(self):
+        self.read_mdstat(open('/proc/mdstat'))
+        self.read_sys_block()
+
+    def examine(self, devices):
+        """Look for md superblocks on the named devices
+
+        The devices with superblocks are recorded.  For each array
+        found, its ARRAY line for mdadm.conf and the names of the
+        devices it was found on are returned.
+        """
+        if not devices:
+            return []
+        return self.read_examine(examine_output(devices))
+
+    def read_examine(self, lines):
+        """Read the output of mdadm --examine --brief --verbose
+        """
+        arrays = []
+        for line in lines:
+            if not line.strip() or line.startswith('mdadm:'):
+                continue
+            if line[0].isspace():
+                line = line.strip()
+                if line.startswith('devices=') and arrays:
+                    for device in line[8:].split(','):
+                        name = device.rsplit('/', 1)[-1]
+                        self.superblocks.add(name)
+                        arrays[-1][1].append(name)
+            else:
+                arrays.append((line.rstrip(), []))
+        return arrays
+
+    def is_new(self, name):
+        """Is the named device unused, as far as we can tell?
+        """
+        return not (name in self.superblocks or
+                    name in self.members or
+                    ('/dev/' + name) in self.pvs)
+
+    def read_mdstat(self, lines):
+        array = None
+        for line in lines:
+            if not line.strip():
+                continue
+            m = mdstat_line(line)
+            if not m:
+                m = mdstat_bitmap(line)
+                if m and array is not None:
+                    array.bitmap = int(m.group(1))
+                    array.bitmap_file = m.group(2)
+                    continue
+                m = mdstat_progress(line)
+                if m and array is not None:
+                    action, percent, finish, speed = m.groups()
+                    array.sync = (action, float(percent), float(finish),
+                                  int(speed))
+                    continue
+                assert (line.startswith('Personalities') or
+                        line.startswith(' ') or
+                        line.startswith('unused devices')), (
+                    "unexpected line", line
+                    )
+                continue
+            mdnum, status, level, data = m.group(1, 2, 3, 4)
+            members = []
+            failed = []
+            spares = []
+            for d in data.strip().split():
+                member = mdstat_member(d)
+                assert member, ("unexpected member", d, line)
+                name, flags = member.groups()
+                members.append(name)
+                if '(F)' in flags:
+                    failed.append(name)
+                elif '(S)' in flags:
+                    spares.append(name)
+            array = Array(mdnum, status, level, members, failed, spares)
+            self.add_array(array)
+
+    def read_sys_block(self):
+        self.read_sizes(sys_block_sizes())
+
+    def read_sizes(self, sizes):
+        """Read block device sizes, as in /sys/block, in 512-byte sectors
+        """
+        for name, sectors in sizes.items():
+            self.devices[name] = int(sectors) * 512
+
+    def read_lvm(self, paths=None):
+        """Read the physical volumes, or just the ones at the given paths
+
+        pvs fails if it's asked about devices that aren't physical
+        volumes, like arrays we created but didn't get to make
+        physical volumes, so we always ask about all of them.
+        """
+        self.read_lvm_report(lvm_report(), paths)
+
+    def read_lvm_report(self, lines, paths=None):
+        """Read the output of pvs --reportformat json
+
+        If paths is given, only physical volumes at those paths are read.
+        """
+        report = json.loads(''.join(lines))
+        for pv in report['report'][0]['pv']:
+            if paths is None or pv['pv_name'] in paths:
+                self.add_pv(pv['pv_name'], pv['vg_name'] or None)
+
+    def add_array(self, array):
+        self.lock.acquire()
+        try:
+            self.arrays[array.mdnum] = array
+            for name in array.members:
+                self.members[name] = array.mdnum
+            self.devices.setdefault('md%s' % array.mdnum, None)
+        finally:
+            self.lock.release()
+
+    def add_pv(self, path, vg=None):
+        self.lock.acquire()
+        try:
+            self.pvs[path] = vg
+            if vg:
+                self.vgs.setdefault(vg, set()).add(path)
+        finally:
+            self.lock.release()
+
+    def allocate_md(self):
+        """Return an unused md number
+        """
+        self.lock.acquire()
+        try:
+            mdnum = 0
+            while (str(mdnum) in self.arrays or
+                   str(mdnum) in self.reserved or
+                   ('md%s' % mdnum) in self.devices
+                   ):
+                mdnum += 1
+            self.reserved.add(str(mdnum))
+            return str(mdnum)
+        finally:
+            self.lock.release()
@@ -13,7 +13,13 @@
 ##############################################################################
 from zope.testing import setupstack
 from os.path import exists as exists_original
+from os import listdir as listdir_original
+from os import close as close_original
+from os import fsync as fsync_original
+from os import open as os_open_original
+from os.path import realpath as realpath_original
 import doctest
+import json
 import manuel.capture
 import manuel.doctest
 import manuel.testing
@@ -23,7 +29,10 @@ import pprint
 import StringIO
 import subprocess
 import sys
+import threading
+import time
 import unittest
+import zc.awsrecipes
 
 def side_effect(m, f=None):
     if f is None:
@@ -36,9 +45,55 @@ def assert_(cond, mess='assertion failed'):
 
 os_path = set(('/usr/sbin', '/bin', '/sbin'))
 
+class Crash(BaseException):
+    """The simulated machine crashed
+    """
+
+# {file system type -> (force option, required extended options...)}
+mkfs_options = dict(
+    ext3=['-F'],
+    ext4=['-F', 'lazy_itable_init=1', 'lazy_journal_init=1'],
+    xfs=['-f'],
+    )
+
+# Default kernel settings:
+proc_sys = {
+    '/proc/sys/dev/raid/speed_limit_min': '1000\n',
+    '/proc/sys/dev/raid/speed_limit_max': '200000\n',
+    }
+
+def uuid(name):
+    return ':'.join([('%08x' % abs(hash(name)))[-8:]]*4)
+
+class FauxFile(StringIO.StringIO):
+
+    def __init__(self, files, name, mode):
+        StringIO.StringIO.__init__(self)
+        self.files = files
+        self.name = name
+        if mode[0] == 'a':
+            self.write(files.get(name, ''))
+
+    def close(self):
+        self.files[self.name] = self.getvalue()
+        StringIO.StringIO.close(self)
+
+    def fileno(self):
+        return self
+
+class FauxDirectory:
+    """A directory opened with os.open, to be synced
+    """
+
+    def __init__(self, name):
+        self.name = name
+
 class FauxPopen:
 
     def __init__(self, handler, command, stdout, stderr):
+        pipe = stdout is subprocess.PIPE
+        if pipe:
+            stdout = StringIO.StringIO()
         if stdout is None:
             stdout = sys.stdout
         if stderr is subprocess.STDOUT:
@@ -51,35 +106,109 @@ class FauxPopen:
         try:
             self.returncode = handler(command, self) or 0
         except AssertionError, e:
-            print 'AssertionError:', e
+            print >>self.stderr, 'AssertionError:', e
             self.returncode = -1
+        if pipe:
+            # Ready for reading:
+            self.stdout = StringIO.StringIO(stdout.getvalue())
 
     def wait(self):
         return self.returncode
 
+    def kill(self):
+        pass
+
+class FauxWatcher:
+    """Wake up when the next simulated device is attached
+    """
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+
+    def wait(self, timeout):
+        now = time.time()
+        pending = [t for t in self.volumes.attach_times.values() if t > now]
+        if pending and (timeout is None or min(pending) - now < timeout):
+            timeout = min(pending) - now
+        if timeout:
+            time.sleep(timeout)
+
+    def close(self):
+        pass
+
 class FauxVolumes:
 
     def __init__(self, test):
         self.init()
         test.globs['volumes'] = self
+        test.globs['Crash'] = Crash
         setupstack.context_manager(
             test, mock.patch('os.path.exists', side_effect=self.exists))
         setupstack.context_manager(
             test, mock.patch('os.rename', side_effect=self.rename))
         setupstack.context_manager(
-            test, mock.patch('zc.awsrecipes.open', create=True,
-                             side_effect=self.open))
-
-        def Popen(command, stdout=None, stderr=None, shell=False):
-            assert_(shell)
-            meth = command.split()[0].rsplit('/', 1)[-1].replace('.', '_')
+            test, mock.patch('os.open', side_effect=self.os_open))
+        setupstack.context_manager(
+            test, mock.patch('os.close', side_effect=self.os_close))
+        setupstack.context_manager(
+            test, mock.patch('os.fsync', side_effect=self.fsync))
+        setupstack.context_manager(
+            test, mock.patch('os.listdir', side_effect=self.listdir))
+        setupstack.context_manager(
+            test, mock.patch('os.path.realpath', side_effect=self.realpath))
+        for module in ('zc.awsrecipes', 'zc.awsrecipes.applied',
+                       'zc.awsrecipes.journal', 'zc.awsrecipes.prewarm',
+                       'zc.awsrecipes.replay', 'zc.awsrecipes.snapshot',
+                       'zc.awsrecipes.status', 'zc.awsrecipes.storage',
+                       'zc.awsrecipes.timing', 'zc.awsrecipes.tuning',
+                       'zc.awsrecipes.watch'):
+            setupstack.context_manager(
+                test, mock.patch(module + '.open', create=True,
+                                 side_effect=self.open))
+        setupstack.context_manager(
+            test, mock.patch('zc.awsrecipes.commands.background',
+                             side_effect=self.background))
+        setupstack.context_manager(
+            test, mock.patch('zc.awsrecipes.devices.watchers',
+                             (lambda paths: FauxWatcher(self), )))
+
+        # Commands may be run from several threads.  Run them one at a
+        # time, so the simulated machine's state stays consistent.
+        # Simulated latency is outside the lock, as commands working
+        # on different devices run concurrently on real machines.
+        lock = self.lock = threading.RLock()
+
+        def Popen(args, stdout=None, stderr=None, shell=False,
+                  close_fds=False):
+            assert_(isinstance(args, list) and not shell)
+            command = ' '.join(args)
+            meth = args[0].rsplit('/', 1)[-1].replace('.', '_')
             meth = getattr(self, meth)
-            return FauxPopen(meth, command, stdout, stderr)
+            if self.crash_before and command.startswith(self.crash_before):
+                # We died just before running the command:
+                self.crash_before = None
+                raise Crash(command)
+            lock.acquire()
+            try:
+                self.commands.append(command)
+                popen = FauxPopen(meth, command, stdout, stderr)
+            finally:
+                lock.release()
+            latency = self.latency(args)
+            if latency:
+                time.sleep(latency)
+            if self.crash and command.startswith(self.crash):
+                # The command ran, but we didn't live to see it finish:
+                self.crash = None
+                raise Crash(command)
+            return popen
         setupstack.context_manager(
             test, mock.patch('subprocess.Popen', side_effect=Popen))
 
+
     def init(self, sds=None, preexisting_mds=None, preexisting_vgs=None):
         self.sds = sds or [] # Set of attached sds: sdb1, sdb2, ...
+        self.sizes = {} # {sdname -> size in sectors}, default 8G
         self.mds = {} # {mdname -> [sdname]}: md1 -> [sdb1, sdb2]
         self.vgs = {} # {vgname -> [mdname]}: vg_sdb -> [md1]
         self.lvs = {} # {vgname -> [mdname]}
@@ -87,33 +216,198 @@ class FauxVolumes:
         self.fss = {} # {vgname -> [mdname]}
                       # note may be fewer mds if not extended
         self.mounts = {}
-        self.pvs = set()
+        self.fstab_mounts = set()
+        self.physical_volumes = set()
         self.preexisting_mds = preexisting_mds or {}
         self.preexisting_vgs = preexisting_vgs or {}
         self.dirs = set()
         self.fstab = {}
+        self.fstypes = {} # {vgname or sdname -> file system type}
+        self.stale = set() # sds with superblocks from some other array
+        self.clean = set() # mds created without an initial resync
+        self.geometry = {} # {mdname -> (raid level, chunk in KiB)}
+        self.bitmaps = {} # {mdname -> bitmap chunk in KiB}
+        self.bitmap_files = {} # {mdname -> external bitmap file}
+        self.resyncing = set() # mds
+        self.progress = {} # {mdname -> resync progress line in mdstat}
+        self.diskstats = [] # /proc/diskstats texts, one per read
+        self.frozen = set() # mount points
+        self.extents = {} # {vgname -> ([lv mdname], [fs mdname])}
+        self.crash = None # Crash after running a command starting with this
+        self.crash_before = None # Crash before running such a command
+        self.dms = {} # {vgname-lvname -> dm number}
+        self.caches = {} # {vgname -> (cache mode, [sdname])}
+        self.files = {} # {path -> data}, for files we write
+        self.synced = set() # files written and synced since
+        self.syncs = [] # the files and directories synced, in order
+        self.files.update(proc_sys)
+        self.attach_times = {} # {sdname -> when it's attached}
+        self.commands = [] # commands run
+        self.mdstat_reads = 0
+        if hasattr(self, 'etc_zim_volumes_setup'):
+            del self.etc_zim_volumes_setup
+
+    # Simulated latencies, in seconds, of commands that take time on
+    # real machines.  They're multiplied by scale, which is 0 unless
+    # set, so that tests run quickly.
+    latencies = {
+        'mdadm --examine': .5,
+        'mdadm --assemble': 1,
+        'mdadm --create': 1,
+        'pvs': .3,
+        'pvcreate': .2,
+        'vgcreate': .3,
+        'vgchange': .5,
+        'vgextend': .2,
+        'lvcreate': .5,
+        'lvextend': .3,
+        'mkfs -t ext3': 30,
+        'mkfs -t ext4': 2,
+        'mkfs -t xfs': 1,
+        'resize2fs': 10,
+        'xfs_growfs': 1,
+        'mount': .1,
+        }
+    scale = 0
+
+    def latency(self, args):
+        if not self.scale:
+            return 0
+        for n in 3, 2, 1:
+            latency = self.latencies.get(' '.join(args[:n]))
+            if latency is not None:
+                return self.scale * latency
+        return 0
+
+    def attach(self, interval, sds=None):
+        """Attach devices one at a time, interval seconds apart
+
+        Devices don't exist until they're attached.
+        """
+        now = time.time()
+        for i, sd in enumerate(sds or self.sds):
+            self.attach_times[sd] = now + (i + 1) * interval
+
+    def attached(self, name):
+        return self.attach_times.get(name, 0) <= time.time()
+
+    # Commands that scan the machine's storage:
+    scan_commands = 'mdadm --examine', 'pvs', 'vgscan', 'pvscan'
+
+    @property
+    def scans(self):
+        return self.mdstat_reads + len(
+            [c for c in self.commands
+             if [s for s in self.scan_commands if c.startswith(s)]])
 
     def terminate(self):
+        # Things recorded on the volumes survive:
+        fstypes, stale, geometry = self.fstypes, self.stale, self.geometry
+        fss, caches, bitmaps = self.fss, self.caches, self.bitmaps
+        bitmap_files = self.bitmap_files
+        extents = dict(self.extents)
+        for vg in self.vgs:
+            extents[vg] = self.lvs.get(vg), self.fss.get(vg)
+        pvs = set(pv for pv in self.physical_volumes
+                  if not [vg for vg in self.vgs.values() if pv in vg])
+        setup = getattr(self, 'etc_zim_volumes_setup', None)
         self.init(self.sds, self.mds, self.vgs)
-        if hasattr(self, 'etc_zim_volumes_setup'):
-            self.etc_zim_volumes = self.etc_zim_volumes_setup
-            del self.etc_zim_volumes_setup
+        self.fstypes, self.stale, self.geometry = fstypes, stale, geometry
+        self.caches, self.bitmaps = caches, bitmaps
+        self.bitmap_files = bitmap_files
+        self.extents, self.physical_volumes = extents, pvs
+        for name, fs in fss.items():
+            if name in self.sds:
+                self.fss[name] = fs
+        if setup is not None:
+            self.etc_zim_volumes = setup
+
+    def replace_instance(self, ephemeral):
+        """Terminate, and lose what was on the ephemeral devices
+        """
+        self.terminate()
+        for vg, pvs in self.preexisting_vgs.items():
+            self.preexisting_vgs[vg] = [
+                pv in ephemeral and '[unknown]' or pv for pv in pvs]
+        for vg, (mode, cache) in self.caches.items():
+            if set(cache) & set(ephemeral):
+                self.lost_caches[vg] = self.caches.pop(vg)
+
+    lost_caches = {}
+
+    def reboot(self):
+        # Unlike terminate, files on the root volume survive, and udev
+        # assembles the arrays as their devices appear.
+        files, dirs, fstab, mds = self.files, self.dirs, self.fstab, self.mds
+        sizes = self.sizes
+        self.terminate()
+        self.files, self.dirs, self.fstab = files, dirs, fstab
+        self.sizes = sizes
+        self.mds = dict(mds)
 
     def exists(self, name):
+        self.lock.acquire()
+        try:
+            return self._exists(name)
+        finally:
+            self.lock.release()
+
+    def _exists(self, name):
+        if name == '/etc/zim/volumes':
+            return hasattr(self, 'etc_zim_volumes')
         if name.startswith('/dev/'):
             name = name[5:]
-            return name in self.sds or name in self.mds
+            return ((name in self.sds and self.attached(name)) or
+                    name in self.mds)
+        if name.startswith('/sys/block/'):
+            name = name[11:]
+            return name in self.sds or name in self.mds or name in self.dms
         if [d for d in self.dirs if d.startswith(name+'/') or d == name]:
             return True
         return exists_original(name)
 
-    def echo(self, command, p):
-        assert_(command.endswith('>> /etc/fstab'))
-        command = command.split()[1:-2]
-        assert_(command[-4:] == ['ext3', 'defaults', '0', '1'])
-        dev, mp = command[:-4]
+    def realpath(self, name):
+        if name.startswith('/dev/') and name.count('/') == 3:
+            # An LVM volume
+            vg, lv = name[5:].split('/')
+            assert_(vg in self.lvs or vg in self.vgs, "no such volume")
+            dm = self.dms.setdefault('%s-%s' % (vg, lv), len(self.dms))
+            return '/dev/dm-%s' % dm
+        return realpath_original(name)
+
+    def listdir(self, name):
+        if name == '/sys/block':
+            return [sd for sd in self.sds if self.attached(sd)
+                    ] + list(self.mds)
+        return listdir_original(name)
+
+    def size(self, name):
+        for dm, n in self.dms.items():
+            if name == 'dm-%s' % n:
+                return sum(self.size(v) for v in self.lvs[dm.split('-')[0]])
+        if name in self.mds:
+            return sum(self.size(sd) for sd in self.mds[name]) // 2
+        return self.sizes.get(name, 16777216)
+
+    def set_fstab(self, data, old):
+        # Lines that were there before needn't be checked again.  Their
+        # volumes may not be active yet.
+        old = set(old.splitlines())
+        self.fstab = {}
+        for line in data.splitlines():
+            if line.startswith('/dev/'):
+                self.add_fstab_line(line.split(), line not in old)
+
+    def add_fstab_line(self, entry, check=True):
+        assert_(entry[-2:] == ['0', '1'])
+        dev, mp, fstype, options = entry[:-2]
         assert_(mp not in self.fstab)
         assert_(not [v for v in self.fstab.values() if v == dev])
+        self.fstab[mp] = dev
+        if not check:
+            return
+        if options != 'defaults':
+            self.check_mount_options(fstype, options)
         assert_(self.exists(mp))
         mapper = '/dev/mapper/'
         if dev.startswith(mapper):
@@ -121,84 +415,315 @@ class FauxVolumes:
             assert_(vg in self.vgs, "bad vg")
             assert_(v == 'data')
             assert_(vg in self.lvs)
+            assert_(fstype == self.fstypes[vg])
         else:
             assert_(dev.startswith('/dev/'))
             assert_(dev[5:] in self.fss)
-
-        self.fstab[mp] = dev
-
-    def open(self, name):
+            assert_(fstype == self.fstypes[dev[5:]])
+
+    # Mount options each file system takes:
+    mount_options = dict(
+        ext3=('strictatime', 'relatime', 'noatime', 'nodiratime', 'commit',
+              'data', 'barrier'),
+        ext4=('strictatime', 'relatime', 'noatime', 'nodiratime', 'commit',
+              'data', 'barrier', 'discard'),
+        xfs=('strictatime', 'relatime', 'noatime', 'nodiratime',
+             'discard'),
+        )
+
+    def check_mount_options(self, fstype, options):
+        options = options.split(',')
+        assert_(len(set(options)) == len(options), "repeated mount option")
+        for option in options:
+            assert_(option.split('=')[0] in self.mount_options[fstype],
+                    "bad mount option")
+
+    def open(self, name, mode='r'):
+        if name == '/etc/fstab':
+            # It's only replaced, by renaming.
+            assert_(mode[0] == 'r')
+        if mode[0] in 'wa':
+            self.synced.discard(name)
+            return FauxFile(self.files, name, mode)
+        if name in self.files:
+            return StringIO.StringIO(self.files[name])
         if name == '/etc/mdadm.conf':
-            return StringIO.StringIO('x' if self.examined_mds else '')
+            return StringIO.StringIO('')
         elif name == '/etc/zim/volumes':
             return StringIO.StringIO(self.etc_zim_volumes)
+        elif (name == '/etc/zim/volumes-setup' and
+              hasattr(self, 'etc_zim_volumes_setup')):
+            return StringIO.StringIO(self.etc_zim_volumes_setup)
+        elif name.startswith('/sys/block/') and name.endswith('/size'):
+            return StringIO.StringIO('%s\n' % self.size(name.split('/')[3]))
+        elif name.startswith('/sys/class/block/') and name.endswith('/size'):
+            return StringIO.StringIO('%s\n' % self.size(name.split('/')[4]))
+        elif name.startswith('/etc/') or name.startswith('/var/lib/zim/'):
+            raise IOError(2, 'No such file or directory', name)
+        elif name == '/proc/mounts':
+            return StringIO.StringIO(''.join(
+                '/dev/%s %s ext3 rw 0 0\n' % (self.mounts.get(mp, 'fstab'), mp)
+                for mp in sorted(set(self.mounts) | self.fstab_mounts)))
+        elif name == '/proc/diskstats':
+            # Each read sees the next sample, and the last one stays.
+            if len(self.diskstats) > 1:
+                return StringIO.StringIO(self.diskstats.pop(0))
+            return StringIO.StringIO(self.diskstats[0])
         assert_(name=='/proc/mdstat')
+        self.mdstat_reads += 1
         return StringIO.StringIO(self.mdstat())
 
+    def background(self, log_path, func, *args):
+        print 'background', func.__name__, args
+        # Growing file systems runs commands, which we can simulate.
+        # Prewarming reads devices, which we can't.
+        if func is zc.awsrecipes.grow:
+            func(*args)
+
+    def os_open(self, name, flags, mode=0777):
+        if [path for path in list(self.files)
+            if os.path.dirname(path) == name]:
+            return FauxDirectory(name)
+        return os_open_original(name, flags, mode)
+
+    def os_close(self, fd):
+        if not isinstance(fd, FauxDirectory):
+            close_original(fd)
+
+    def fsync(self, fd):
+        if isinstance(fd, FauxFile):
+            assert_(not fd.closed)
+            self.synced.add(fd.name)
+        elif not isinstance(fd, FauxDirectory):
+            return fsync_original(fd)
+        self.syncs.append(fd.name)
+
     def rename(self, src, dest):
+        if src in self.files:
+            # Files we replace are synced first, so they survive crashes.
+            assert_(src in self.synced, "renamed before it was synced")
+            old = self.files.get(dest, '')
+            self.files[dest] = self.files.pop(src)
+            if dest == '/etc/fstab':
+                self.set_fstab(self.files[dest], old)
+            return
         assert_(src == '/etc/zim/volumes')
         assert_(dest == '/etc/zim/volumes-setup')
         self.etc_zim_volumes_setup = self.etc_zim_volumes
         del self.etc_zim_volumes
         print 'rename', src, dest
 
+    def blockdev(self, command, p):
+        args = command.split()
+        assert_(args[1] == '--flushbufs')
+        [path] = args[2:]
+        assert_(path.startswith('/dev/'))
+        name = path[5:]
+        if '/' in name:
+            assert_(name.split('/')[0] in self.lvs, "no such volume")
+        else:
+            assert_(name in self.sds or name in self.mds, "no such device")
+
+    def blkid(self, command, p):
+        args = command.split()
+        assert_(args[1] == '-p')
+        [path] = args[2:]
+        assert_(path.startswith('/dev/') and path[5:] in self.sds)
+        name = path[5:]
+        members = set(self.stale)
+        for sds in self.preexisting_mds.values() + self.mds.values():
+            members.update(sds)
+        if name in self.fss:
+            found = self.fstypes.get(name, 'ext3')
+        elif name in members:
+            found = 'linux_raid_member'
+        elif name in self.physical_volumes:
+            found = 'LVM2_member'
+        else:
+            return 2 # Nothing found
+        print >>p.stdout, '%s: TYPE="%s"' % (path, found)
+
+    def fsfreeze(self, command, p):
+        args = command.split()
+        [mp] = args[2:]
+        assert_(mp in self.mounts or mp in self.fstab_mounts, "not mounted")
+        if args[1] == '--freeze':
+            assert_(mp not in self.frozen, "already frozen")
+            self.frozen.add(mp)
+        else:
+            assert_(args[1] == '--unfreeze')
+            assert_(mp in self.frozen, "not frozen")
+            self.frozen.remove(mp)
+
+    def sync(self, command, p):
+        assert_(command == 'sync')
+
     def ln(self, command, p):
         args = command.split()
         assert_(args[1] == '-s')
         src, dest = args[2:]
+        self.dirs.add(dest)
         # give up. doctest handles other assertions :)
 
     def lvcreate(self, command, p):
         args = command.split()
-        assert_(args[1:5] == '-l +100%FREE -n data'.split())
-        [vg] = args[5:]
+        if args[1:3] == ['--type', 'cache']:
+            assert_(args[3] == '--cachemode')
+            mode = args[4]
+            assert_(args[5:9] == '-l 100%PVS -n cache'.split())
+            vg, lv = args[9].split('/')
+            assert_(lv == 'data' and vg in self.lvs)
+            assert_(vg not in self.caches, "already cached")
+            cache = [v[5:] for v in args[10:]]
+            assert_(not [v for v in cache if v not in self.vgs[vg]])
+            self.caches[vg] = mode, cache
+            return
+        assert_(args[1:3] == '-l +100%FREE'.split())
+        del args[1:3]
+        if args[1] == '-i':
+            stripes, size = int(args[2]), args[4]
+            assert_(args[3] == '-I' and size[-1] == 'k')
+            assert_(1 <= stripes <= len(self.vgs[args[-1]]), "stripes")
+            del args[1:5]
+        assert_(args[1:3] == '-n data'.split())
+        [vg] = args[3:]
         assert_(vg not in self.lvs)
-        self.lvs[vg] = self.vgs[vg]
+        self.lvs[vg] = self.vgs[vg][:]
 
     def lvextend(self, command, p):
         args = command.split()
         assert_(args[1:3] == '-l +100%FREE'.split())
-        [lv] = args[3:]
+        lv = args[3]
         assert_(lv.startswith('/dev/'))
         assert_(lv.endswith('/data'))
         vg = lv[5:-5]
         assert_(vg in self.lvs)
-        self.lvs[vg] = self.vgs[vg][:]
+        pvs = [pv[5:] for pv in args[4:]]
+        if vg in self.caches:
+            assert_(pvs, "extending onto the cache")
+        self.lvs[vg] = self.lvs[vg] + (
+            pvs or [v for v in self.vgs[vg] if v not in self.lvs[vg]])
 
     mdstat_data = None
     def mdstat(self):
         if self.mdstat_data:
             return self.mdstat_data
         return '\n'.join(
-            "%s : active raid10 %s" % (
-                md, ' '.join("%s[0]" % sd for sd in data)
-                )
+            "%s : active raid%s %s" % (
+                md, self.geometry.get(md, ('10',))[0],
+                ' '.join("%s[0]" % sd for sd in data)
+                ) + (md in self.bitmaps and
+                     "\n      bitmap: 0/1 pages [0KB], %sKB chunk"
+                     % self.bitmaps[md] + (
+                         md in self.bitmap_files and
+                         ", file: " + self.bitmap_files[md] or '') or ''
+                ) + (md in self.progress and
+                     "\n      " + self.progress[md] or '')
             for md, data in sorted(self.mds.items())
             )+'\n'
 
     def mdadm(self, command, p):
         args = command.split()
-        if command == '/sbin/mdadm --examine --scan >>/etc/mdadm.conf':
-            self.examined_mds = self.preexisting_mds
-        elif command == '/sbin/mdadm -A --scan':
-            assert_(self.examined_mds)
-            self.mds.update(self.examined_mds)
-        elif args[1:5] == '--create --metadata 1.2 -l10'.split():
-            n, md = args[5:7]
+        if args[1:4] == '--examine --brief --verbose'.split():
+            devices = args[4:]
+            assert_(devices and not [d for d in devices
+                                     if not d.startswith('/dev/')])
+            devices = set(d[5:] for d in devices)
+            # Arrays with members on the devices, and how many they had:
+            arrays = [(md, sds, len(sds))
+                      for md, sds in sorted(self.preexisting_mds.items())]
+            if self.stale:
+                # Part of an array from elsewhere, missing a member:
+                arrays.append(('old', sorted(self.stale),
+                               len(self.stale) + 1))
+            found = set()
+            for md, sds, n in arrays:
+                sds = [sd for sd in sds if sd in devices]
+                if not sds:
+                    continue
+                found.update(sds)
+                print >>p.stdout, (
+                    'ARRAY /dev/md/%s level=raid10 metadata=1.2'
+                    ' num-devices=%s UUID=%s name=%s:%s'
+                    % (md.replace('md', ''), n, uuid(md),
+                       md == 'old' and 'other' or 'host',
+                       md.replace('md', '')))
+                print >>p.stdout, (
+                    '   devices=%s' % ','.join('/dev/'+sd for sd in sds))
+            for device in sorted(devices - found):
+                print >>p.stdout, (
+                    'mdadm: No md superblock detected on /dev/%s.' % device)
+            if devices - found:
+                return 1
+        elif args[1] == '--assemble':
+            name, option = args[2:4]
+            mds = [md for md in self.preexisting_mds
+                   if name == '/dev/md/' + md[2:]]
+            assert_(mds, "Not a known array %s" % name)
+            md = mds[0]
+            assert_(option == '--uuid=' + uuid(md))
+            assert_(md not in self.mds, "already assembled")
+            assert_(sorted(args[4:]) ==
+                    sorted('/dev/' + sd for sd in self.preexisting_mds[md]))
+            self.mds[md] = self.preexisting_mds[md]
+        elif args[1:4] == '--create --metadata 1.2'.split():
+            level, chunk = args[4:6]
+            assert_(level in ('-l0', '-l10'), level)
+            assert_(chunk.startswith('-c'))
+            del args[4:6]
+            clean = args[4] == '--assume-clean'
+            if clean:
+                assert_(level == '-l10')
+                del args[4]
+            bitmap = None
+            while args[4].startswith('--bitmap'):
+                bitmap = self.bitmap_option(args.pop(4), bitmap)
+            n, md = args[4:6]
             assert_(md.startswith('/dev/'))
             md = md[5:]
-            sds = args[7:]
+            if bitmap:
+                self.bitmaps[md] = bitmap
+            sds = args[6:]
             assert_(not [sd for sd in sds if not sd.startswith('/dev/')])
             sds = [sd[5:] for sd in sds]
             assert_(md not in self.mds)
             assert_(n == ('-n%s' % len(sds)))
             assert_(len(set(sds)) == len(sds))
             assert_(not [sd for sd in sds if sd not in self.sds])
+            if clean:
+                assert_(not [sd for sd in sds if sd in self.stale],
+                        "assumed clean, but not new")
+                self.clean.add(md)
             self.mds[md] = sds
+            self.geometry[md] = level[2:], int(chunk[2:])
+        elif args[1] == '--grow':
+            md = args.pop()[5:]
+            assert_(md in self.mds)
+            assert_(md not in self.resyncing, "resyncing")
+            bitmap = None
+            for option in args[2:]:
+                bitmap = self.bitmap_option(option, bitmap)
+            if bitmap:
+                assert_(md not in self.bitmaps, "already has a bitmap")
+                self.bitmaps[md] = bitmap
+            else:
+                assert_(md in self.bitmaps, "no bitmap")
+                del self.bitmaps[md]
+                self.bitmap_files.pop(md, None)
         else:
             assert_(0, "Unexpected command %r" % command)
 
-        self.preexisting_mds = self.mds.copy()
+        self.preexisting_mds.update(self.mds)
+
+    def bitmap_option(self, option, bitmap):
+        # Return the bitmap chunk size, or 0 for none
+        if option == '--bitmap=none':
+            return 0
+        if option == '--bitmap=internal':
+            return 65536 # mdadm's choice, for our small devices
+        assert_(option.startswith('--bitmap-chunk=') and option[-1] == 'K')
+        assert_(bitmap, "chunk without a bitmap")
+        return int(option[15:-1])
 
     def mkdir(self, command, p):
         args = command.split()
@@ -208,56 +733,98 @@ class FauxVolumes:
 
     def mkfs(self, command, p):
         args = command.split()
-        assert_(args[1:3] == '-t ext3'.split())
-        [lv] = args[3:]
-        assert_(lv.startswith('/dev/'))
-        assert_(lv.endswith('/data'))
-        vg = lv[5:-5]
-        assert_(vg not in self.fss)
-        self.fss[vg] = self.lvs[vg][:]
-
-    def mkfs_ext3(self, command, p):
-        force, dev = command.split()[1:]
-        assert_(force == '-F', "bad force")
+        assert_(args[1] == '-t')
+        fstype = args[2]
+        assert_(fstype in mkfs_options, fstype)
+        args = args[3:]
+        force = args[0] in ('-F', '-f')
+        if force:
+            assert_(args.pop(0) == mkfs_options[fstype][0], "bad force")
+        dev = args.pop()
+        options = dict(zip(args[::2], args[1::2]))
+        extended = options.pop('-E', '').split(',')
+        for option in mkfs_options[fstype][1:]:
+            assert_(option in extended, "missing " + option)
+        if fstype == 'xfs':
+            assert_(not options.pop('-d', 'su=').startswith('su=0'))
+        else:
+            assert_(options.pop('-b', '4096') == '4096')
+        assert_(not options, options)
         assert_(dev.startswith('/dev/'))
-        dev = dev[5:]
-        assert_(dev in self.sds)
-        assert_(dev not in self.fss)
-        self.fss[dev] = dev
+        if dev.endswith('/data'):
+            vg = dev[5:-5]
+            assert_(vg not in self.fss)
+            self.fss[vg] = self.lvs[vg][:]
+            self.fstypes[vg] = fstype
+        else:
+            dev = dev[5:]
+            assert_(force, "whole device without force")
+            assert_(dev in self.sds)
+            assert_(dev not in self.fss)
+            self.fss[dev] = dev
+            self.fstypes[dev] = fstype
 
     def mount(self, command, p):
         args = command.split()
         if len(args) == 2:
             assert(args[1] in self.fstab)
+            assert_(args[1] not in self.fstab_mounts, "mounts")
+            dev = self.fstab[args[1]]
+            if dev.startswith('/dev/mapper/'):
+                assert_(dev[12:].split('-')[0] in self.fss, "no file system")
+            else:
+                assert_(dev[5:] in self.fss, "no file system")
+            self.fstab_mounts.add(args[1])
             return
 
-        assert_(args[1:3] == '-t ext3'.split())
+        assert_(args[1] == '-t')
+        if args[3] == '-o':
+            self.check_mount_options(args[2], args[4])
+            del args[3:5]
         [lv, mp] = args[3:]
         assert_(lv.startswith('/dev/'))
         vg = lv[5:]
         if lv.endswith('/data'):
             vg = vg[:-5]
         assert_(vg in self.fss, "no file system")
+        assert_(args[2] == self.fstypes.get(vg, 'ext3'), "wrong fs type")
         assert_(mp in self.dirs, "dirs")
         assert_(mp not in self.mounts, "mounts")
         self.mounts[mp] = vg
 
     def pvcreate(self, command, p):
         args = command.split()
+        if args[1] == '--dataalignment':
+            assert_(args[2][:-1].isdigit() and args[2][-1] == 'k')
+            del args[1:3]
         [vol] = args[1:]
         assert_(vol.startswith('/dev/'))
         vol = vol[5:]
-        assert_((vol in self.mds or vol in self.sds) and vol not in self.pvs)
-        self.pvs.add(vol)
+        assert_((vol in self.mds or vol in self.sds) and
+                vol not in self.physical_volumes)
+        self.physical_volumes.add(vol)
 
-    def pvscan(self, command, p):
+    def pvs(self, command, p):
         args = command.split()
-        assert_(not args[1:])
-        for vg, mds in self.vgs.items():
-            for md in mds:
-                print >>p.stdout, (
-                    '  PV /dev/%s   VG %s   lvm2 ' % (md, vg)
-                    )
+        assert_(args[1:5] == '--reportformat json -o pv_name,vg_name'.split())
+        pvs = dict((pv, '') for pv in self.physical_volumes)
+        for vgs in self.preexisting_vgs, self.vgs:
+            for vg, vols in vgs.items():
+                for vol in vols:
+                    pvs[vol] = vg
+        # Arrays that aren't running can't be seen:
+        for pv in list(pvs):
+            if pv.startswith('md') and pv not in self.mds:
+                del pvs[pv]
+        if args[5:]:
+            assert_(not [a for a in args[5:] if not a.startswith('/dev/')])
+            for pv in args[5:]:
+                assert_(pv[5:] in pvs, "No physical volume %s" % pv)
+            pvs = dict((pv[5:], pvs[pv[5:]]) for pv in args[5:])
+        print >>p.stdout, json.dumps(dict(report=[dict(pv=[
+            dict(pv_name=pv[0] == '[' and pv or '/dev/'+pv, vg_name=vg)
+            for pv, vg in sorted(pvs.items())
+            ])]), indent=2)
 
     def resize2fs(self, command, p):
         args = command.split()
@@ -266,6 +833,8 @@ class FauxVolumes:
         assert_(lv.endswith('/data'))
         vg = lv[5:-5]
         assert_(vg in self.fss)
+        assert_(vg in self.mounts.values(), "not mounted")
+        assert_(self.fstypes.get(vg, 'ext3') in ('ext3', 'ext4'))
         self.fss[vg] = self.lvs[vg][:]
 
     def status(self):
@@ -274,19 +843,42 @@ class FauxVolumes:
             for md in sorted(self.fss[vg]):
                 print '   ', md, self.mds[md]
 
+    def xfs_growfs(self, command, p):
+        [mp] = command.split()[1:]
+        assert_(mp in self.mounts, "not mounted")
+        vg = self.mounts[mp]
+        assert_(self.fstypes[vg] == 'xfs')
+        self.fss[vg] = self.lvs[vg][:]
+
     def vgchange(self, command, p):
         args = command.split()
         assert_(args[1:3] == '-a y'.split())
         [vg] = args[3:]
+        if vg in self.mounts.values():
+            return # Already active
         assert_(vg not in self.vgs)
         assert_(vg not in self.lvs)
         assert_(vg not in self.fss)
+        assert_('[unknown]' not in self.preexisting_vgs[vg], "partial")
         for md in self.preexisting_vgs[vg]:
-            assert_(md not in self.pvs)
-            self.pvs.add(md)
+            assert_(md not in self.physical_volumes)
+            self.physical_volumes.add(md)
         self.vgs[vg] = self.preexisting_vgs[vg]
-        self.lvs[vg] = self.vgs[vg][:]
-        self.fss[vg] = self.vgs[vg][:]
+        cache = self.caches.get(vg, (None, ()))[1]
+        lvs = [v for v in self.vgs[vg] if v not in cache]
+        lvs, fss = self.extents.get(vg, (lvs, lvs))
+        if lvs is not None:
+            self.lvs[vg] = lvs[:]
+        if fss is not None:
+            self.fss[vg] = fss[:]
+
+    def vgreduce(self, command, p):
+        args = command.split()
+        assert_(args[1:3] == '--removemissing --force'.split())
+        [vg] = args[3:]
+        self.preexisting_vgs[vg] = [
+            pv for pv in self.preexisting_vgs[vg] if pv != '[unknown]']
+        self.lost_caches.pop(vg, None)
 
     def vgcreate(self, command, p):
         args = command.split()[1:]
@@ -296,27 +888,20 @@ class FauxVolumes:
                 "starts w /dev/ %r" % vols)
         vols = [v[5:] for v in vols]
         assert_(not [v for v in vols if not (
-            (v in self.pvs or v in self.mds) and
+            (v in self.physical_volumes or v in self.mds) and
             not [vg_ for vg_ in self.vgs if v in self.vgs[vg_]]
             )], "invalid volume")
         self.vgs[vg] = vols
-        self.pvs.update(vols)
+        self.physical_volumes.update(vols)
 
     def vgextend(self, command, p):
         args = command.split()
-        vg, md = args[1:]
-        assert_(md.startswith('/dev/'))
-        md = md[5:]
-        assert_(md in self.pvs)
-        self.vgs[vg].append(md)
-
-    def vgscan(self, command, p):
-        args = command.split()
-        assert_(not args[1:])
-        for vg in self.preexisting_vgs:
-            print >>p.stdout, (
-                '  Found volume group "%s" using metadata type lvm2'
-                % vg)
+        vg = args[1]
+        for pv in args[2:]:
+            assert_(pv.startswith('/dev/'))
+            pv = pv[5:]
+            assert_(pv in self.physical_volumes)
+            self.vgs[vg].append(pv)
 
 def setup(test):
 
@@ -334,6 +919,11 @@ def setup(test):
 
     volumes = FauxVolumes(test)
 
+def setup_prewarm(test):
+    setupstack.setUpDirectory(test)
+    setupstack.context_manager(
+        test, mock.patch('zc.awsrecipes.prewarm.progress_dir', 'progress'))
+
 def test_suite():
     return unittest.TestSuite((
         manuel.testing.TestSuite(
@@ -341,4 +931,41 @@ def test_suite():
             'main.test',
             setUp=setup, tearDown=setupstack.tearDown,
             ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'devices.test',
+            setUp=setupstack.setUpDirectory, tearDown=setupstack.tearDown,
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'storage.test',
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'replay.test',
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'benchmark.test',
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'commands.test',
+            setUp=setupstack.setUpDirectory, tearDown=setupstack.tearDown,
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'snapshot.test',
+            setUp=setup, tearDown=setupstack.tearDown,
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'prewarm.test',
+            setUp=setup_prewarm, tearDown=setupstack.tearDown,
+            ),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel() + manuel.capture.Manuel(),
+            'status.test',
+            setUp=setup, tearDown=setupstack.tearDown,
+            ),
         ))
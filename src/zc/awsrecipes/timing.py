@@ -0,0 +1,174 @@
+"""Record how long setting up volumes takes
+
+A Report records the phases of a setup run, each volume set up and
+each command run, along with device counts and the number of bytes
+formatted.  It's saved as JSON and, optionally, as a Prometheus
+textfile-collector file.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import zc.awsrecipes.commands
+import zc.awsrecipes.storage
+
+class Report:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self.phases = []
+        self.volumes = []
+        self.commands = []
+        self.formatted = 0 # bytes
+
+    def offset(self, t=None):
+        if t is None:
+            t = time.time()
+        return round(t - self.start, 6)
+
+    def add(self, records, record):
+        self.lock.acquire()
+        try:
+            records.append(record)
+        finally:
+            self.lock.release()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of setting up
+
+        The phase record is a dictionary, to which the caller can add
+        counts.
+        """
+        record = dict(name=name, start=self.offset())
+        self.add(self.phases, record)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record['duration'] = round(time.time() - start, 6)
+
+    def volume(self, mount_point):
+        """Start recording how long setting up a volume takes
+
+        Return a function to call when it's done.
+        """
+        record = dict(mount_point=mount_point, start=self.offset())
+        self.add(self.volumes, record)
+        start = time.time()
+        def done():
+            record['duration'] = round(time.time() - start, 6)
+        return done
+
+    def command(self, result):
+        end = time.time()
+        record = dict(command=result.command, status=result.status,
+                      attempts=result.attempts,
+                      start=self.offset(end - result.duration),
+                      duration=round(result.duration, 6))
+        if result.argv[0] == 'mkfs' and result.ok:
+            size = device_size(result.argv[-1])
+            record['bytes'] = size
+            self.lock.acquire()
+            try:
+                self.formatted += size or 0
+            finally:
+                self.lock.release()
+        self.add(self.commands, record)
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Record commands run, and the total time taken
+        """
+        zc.awsrecipes.commands.listeners.append(self.command)
+        try:
+            try:
+                yield self
+            except Exception, v:
+                self.error = '%s: %s' % (v.__class__.__name__, v)
+                raise
+        finally:
+            zc.awsrecipes.commands.listeners.remove(self.command)
+            self.duration = round(time.time() - self.start, 6)
+
+    def data(self):
+        return dict(
+            start=self.start,
+            duration=self.duration,
+            error=self.error,
+            formatted_bytes=self.formatted,
+            phases=self.phases,
+            volumes=sorted(self.volumes, key=lambda r: r['start']),
+            commands=sorted(self.commands, key=lambda r: r['start']),
+            )
+
+    def save(self, path):
+        f = open(path, 'w')
+        json.dump(self.data(), f, indent=2, sort_keys=True,
+              separators=(',', ': '))
+        f.write('\n')
+        f.close()
+
+    def save_textfile(self, path):
+        """Save metrics for the Prometheus node exporter's textfile collector
+
+        The file is replaced with zc.awsrecipes.save_file, so the
+        collector never sees part of it.
+        """
+        lines = []
+        def gauge(name, help, values):
+            metric(lines, 'zim_volumes_setup_' + name, help, values)
+
+        gauge('timestamp_seconds', 'When setting up volumes started.',
+              [((), self.start)])
+        gauge('duration_seconds', 'Time taken to set up volumes.',
+              [((), self.duration)])
+        gauge('success', 'Whether setting up volumes succeeded.',
+              [((), int(self.error is None))])
+        gauge('phase_duration_seconds', 'Time taken by each phase.',
+              [((('phase', r['name']), ), r['duration'])
+               for r in self.phases])
+        gauge('volume_duration_seconds', 'Time taken to set up a volume.',
+              [((('mount_point', r['mount_point']), ), r['duration'])
+               for r in sorted(self.volumes, key=lambda r: r['start'])])
+        counts = {}
+        durations = {}
+        for r in self.commands:
+            name = r['command'].split()[0]
+            counts[name] = counts.get(name, 0) + 1
+            durations[name] = durations.get(name, 0) + r['duration']
+        gauge('commands', 'Number of commands run.',
+              [((('command', name), ), count)
+               for name, count in sorted(counts.items())])
+        gauge('command_duration_seconds', 'Time spent running commands.',
+              [((('command', name), ), round(duration, 6))
+               for name, duration in sorted(durations.items())])
+        gauge('formatted_bytes', 'Bytes of file system formatted.',
+              [((), self.formatted)])
+
+        zc.awsrecipes.save_file(path, ''.join(line + '\n' for line in lines))
+
+def metric(lines, name, help, values):
+    """Add a Prometheus gauge, with values as (labels, value) pairs
+    """
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s gauge' % name)
+    for labels, value in values:
+        if labels:
+            labels = '{%s}' % ','.join(
+                '%s="%s"' % (label, quote(text)) for label, text in labels)
+        lines.append('%s%s %s' % (name, labels or '', value))
+
+def quote(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+def device_size(path):
+    try:
+        return zc.awsrecipes.storage.device_size(
+            os.path.basename(os.path.realpath(path)))
+    except EnvironmentError:
+        return None
@@ -0,0 +1,129 @@
+"""Tune the block devices under a volume
+
+Tuning is driven by options in /etc/zim/volumes:
+
+readahead
+  Readahead, in KiB, for every device in the stack: the member
+  devices, md arrays and the LVM (dm) volume.
+
+scheduler
+  I/O scheduler for the member devices.
+
+nr_requests
+  Request queue size for the member devices.
+
+stripe_cache
+  Stripe cache size for md arrays that have a stripe cache.
+
+Settings are made through /sys, and also saved as udev rules so they
+survive reboots.
+"""
+import os
+import re
+import zc.awsrecipes
+
+options = 'readahead', 'scheduler', 'nr_requests', 'stripe_cache'
+
+rules = '/etc/udev/rules.d/61-zim%s.rules'
+
+def disk(name):
+    # Partitions don't have queues.  Their disks do.  Partitions of
+    # disks whose names end in digits, like nvme0n1p1, have a "p"
+    # before the partition number.
+    if os.path.exists('/sys/block/' + name):
+        return name
+    if name.startswith('nvme') or name.startswith('mmcblk'):
+        return re.sub(r'p\d+$', '', name)
+    return re.sub(r'\d+$', '', name)
+
+def dm_name(vg, lv):
+    # Device mapper doubles dashes in volume group and volume names.
+    return '%s-%s' % (vg.replace('-', '--'), lv.replace('-', '--'))
+
+def number(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Bad number", name, value)
+
+class Tuning:
+
+    def __init__(self, readahead=None, scheduler=None, nr_requests=None,
+                 stripe_cache=None):
+        if readahead is not None:
+            readahead = number('readahead', readahead)
+        if nr_requests is not None:
+            nr_requests = number('nr_requests', nr_requests)
+        if stripe_cache is not None:
+            stripe_cache = number('stripe_cache', stripe_cache)
+        self.readahead = readahead
+        self.scheduler = scheduler
+        self.nr_requests = nr_requests
+        self.stripe_cache = stripe_cache
+
+    def __nonzero__(self):
+        return not (self.readahead is None and self.scheduler is None and
+                    self.nr_requests is None and self.stripe_cache is None)
+
+    def member_settings(self):
+        return [(attr, value) for (attr, value) in (
+            ('queue/scheduler', self.scheduler),
+            ('queue/nr_requests', self.nr_requests),
+            ('queue/read_ahead_kb', self.readahead),
+            ) if value is not None]
+
+    def apply(self, mount_point, members=(), mds=(), dm=None):
+        """Tune the devices under a volume
+
+        members are the names of the underlying devices (sdb1, ...),
+        mds are md numbers, and dm is the path of an LVM volume.
+        """
+        if not self:
+            return
+
+        write = zc.awsrecipes.write
+        lines = []
+
+        settings = self.member_settings()
+        if settings and members:
+            disks = sorted(set(disk(name) for name in members))
+            for name in disks:
+                for attr, value in settings:
+                    write('/sys/block/%s/%s' % (name, attr), value)
+            lines.append(rule('KERNEL=="%s"' % '|'.join(disks), settings))
+
+        for mdnum in sorted(mds):
+            name = 'md%s' % mdnum
+            settings = []
+            if self.readahead is not None:
+                settings.append(('queue/read_ahead_kb', self.readahead))
+            if self.stripe_cache is not None:
+                path = '/sys/block/%s/md/stripe_cache_size' % name
+                if os.path.exists(path):
+                    settings.append(('md/stripe_cache_size',
+                                     self.stripe_cache))
+                else:
+                    zc.awsrecipes.say('no stripe cache for ' + name)
+            for attr, value in settings:
+                write('/sys/block/%s/%s' % (name, attr), value)
+            if settings:
+                lines.append(rule('KERNEL=="%s"' % name, settings))
+
+        if dm is not None and self.readahead is not None:
+            name = os.path.basename(os.path.realpath(dm))
+            write('/sys/block/%s/queue/read_ahead_kb' % name, self.readahead)
+            vg, lv = dm.split('/')[-2:]
+            lines.append(rule(
+                'ENV{DM_NAME}=="%s"' % dm_name(vg, lv),
+                [('queue/read_ahead_kb', self.readahead)]))
+
+        path = rules % mount_point.replace('/', '-')
+        zc.awsrecipes.say('save ' + path)
+        f = open(path, 'w')
+        f.write(''.join(line + '\n' for line in lines))
+        f.close()
+
+def rule(match, settings):
+    return ', '.join(
+        ['ACTION=="add|change"', 'SUBSYSTEM=="block"', match] +
+        ['ATTR{%s}="%s"' % setting for setting in settings])
@@ -0,0 +1,163 @@
+"""Add devices to raid volumes as they're attached
+
+Rather than editing /etc/zim/volumes and running setup-volumes again,
+``setup-volumes --watch`` keeps running after setting up, and when
+devices named like the members of a configured raid volume (sdb5 for
+a volume made of sdb1 through sdb4, say) are attached, it makes a new
+array from them, adds it to the volume and grows the file system.
+
+EBS volumes are usually attached in batches, one at a time, so we
+wait until no devices have been attached for a while (the debounce
+window) before making an array, so that a batch leads to one array
+and one resize.
+"""
+import errno
+import os
+import select
+import time
+import zc.awsrecipes
+import zc.awsrecipes.devices
+import zc.awsrecipes.journal
+import zc.awsrecipes.plan
+import zc.awsrecipes.storage
+
+config_path = '/etc/zim/volumes-setup'
+
+debounce = 30 # seconds without attachments before we add devices
+
+# The fewest devices an array can be made of:
+min_members = {'0': 1, '10': 2}
+
+class HotAttach:
+
+    def __init__(self, debounce=debounce):
+        self.debounce = debounce
+        self.pending = set()
+        self.ignored = set() # Devices we couldn't add, or found in use
+        self.last_change = None
+
+    def volumes(self, lines):
+        """Return the configured raid volume lines, by device prefix
+        """
+        result = {}
+        for line in lines:
+            mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+            if (len(sdvols) > 1 and not zc.awsrecipes.lvname(sdvols[0])):
+                result[sdvols[0][:3]] = line
+        return result
+
+    def attached(self, volumes, lines):
+        """Return devices with a raid volume's prefix that aren't in use
+
+        Devices configured for any volume, members of arrays and
+        mounted devices are in use.
+        """
+        in_use = set()
+        for line in lines:
+            mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+            in_use.update(sdvols)
+            in_use.update(options.get('cache', '').split(','))
+        storage = zc.awsrecipes.storage.StorageSnapshot()
+        storage.read_mdstat(open('/proc/mdstat'))
+        in_use.update(storage.members)
+        f = open('/proc/mounts')
+        in_use.update(line.split()[0][5:] for line in f
+                      if line.startswith('/dev/'))
+        f.close()
+        return set(name for name in os.listdir('/sys/block')
+                   if name[:3] in volumes and name != name[:3]
+                   and name not in in_use and name not in self.ignored)
+
+    def check(self, now):
+        """Add devices if none have been attached for a while
+
+        Return the number of seconds until we should check again, or
+        None if there's nothing to wait for.
+        """
+        lines = zc.awsrecipes.read_config(config_path)
+        volumes = self.volumes(lines)
+        attached = self.attached(volumes, lines)
+        if attached != self.pending:
+            if attached - self.pending:
+                zc.awsrecipes.say('attached %s' % ' '.join(
+                    sorted(attached - self.pending)))
+            self.pending = attached
+            self.last_change = now
+        if not self.pending:
+            return None
+        remaining = self.last_change + self.debounce - now
+        if remaining > 0:
+            return remaining
+
+        # The devices may have been used before, here or on another
+        # machine, so look for md superblocks and physical volumes on
+        # them, as setting up does:
+        storage = zc.awsrecipes.storage.StorageSnapshot()
+        storage.scan(examine=self.pending)
+        in_use = sorted(name for name in self.pending
+                        if name in storage.members or
+                        '/dev/' + name in storage.pvs)
+        if in_use:
+            zc.awsrecipes.say('skipping %s, in use' % ' '.join(in_use))
+            self.ignored.update(in_use)
+            self.pending.difference_update(in_use)
+
+        by_prefix = {}
+        for name in self.pending:
+            by_prefix.setdefault(name[:3], []).append(name)
+        for prefix, names in sorted(by_prefix.items()):
+            line = volumes[prefix]
+            level = zc.awsrecipes.parse_line(line)[2].get('raid', '10')
+            if len(names) < min_members.get(level, 1):
+                zc.awsrecipes.say(
+                    'waiting for more devices for %s' % prefix)
+                continue
+            try:
+                extend(line, sorted(names), storage)
+            except Exception, v:
+                zc.awsrecipes.say("couldn't add %s: %s: %s" % (
+                    ' '.join(sorted(names)), v.__class__.__name__, v))
+                self.ignored.update(names)
+            self.pending.difference_update(names)
+        return None
+
+    def run(self):
+        w = zc.awsrecipes.devices.watcher(['/dev/'])
+        try:
+            while 1:
+                timeout = self.check(time.time())
+                try:
+                    w.wait(timeout)
+                except select.error, v:
+                    if v.args[0] != errno.EINTR:
+                        raise
+        finally:
+            w.close()
+
+def extend(line, names, storage):
+    """Add an array made of the named devices to a raid volume
+
+    storage is a storage snapshot, made after the devices were
+    attached, in which they were examined for md superblocks.
+    """
+    mount_point, sdvols, options = zc.awsrecipes.parse_line(line)
+    zc.awsrecipes.say('adding %s to %s' % (' '.join(names), mount_point))
+    sdvols.extend(names)
+    prefix = sdvols[0][:3]
+    lv = zc.awsrecipes.LogicalVolume(prefix, sdvols, mount_point, **options)
+
+    plan = zc.awsrecipes.plan.Plan()
+    zc.awsrecipes.discover(storage, {prefix: lv}, set(sdvols), [], plan)
+    assert lv.logical, ("No volume group to add to", prefix)
+    lv.reserve_md(storage)
+    grows = []
+    lv.plan(plan, storage, grows, zc.awsrecipes.journal.Journal.load())
+    plan.run()
+
+    # Record the new devices, so they're used if the machine is
+    # set up again:
+    lines = [l == line and ' '.join([line] + names) or l
+             for l in zc.awsrecipes.read_config(config_path)]
+    zc.awsrecipes.save_file(config_path, ''.join(l + '\n' for l in lines))
+
+    zc.awsrecipes.grow(grows)